@@ -31,6 +31,24 @@ CREATE TABLE `dns_addendum` (
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `dns_journal`
+--
+
+DROP TABLE IF EXISTS `dns_journal`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `dns_journal` (
+  `id` bigint(20) unsigned NOT NULL AUTO_INCREMENT,
+  `realm` varchar(10) DEFAULT NULL,
+  `site_id` varchar(3) DEFAULT NULL,
+  `interface` varchar(15) DEFAULT NULL,
+  `zone` varchar(100) DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `id` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `groups`
 --
@@ -47,7 +65,8 @@ CREATE TABLE `groups` (
   `gid` int(11) NOT NULL,
   `id` bigint(20) unsigned NOT NULL AUTO_INCREMENT,
   PRIMARY KEY (`groupname`,`realm`,`site_id`),
-  UNIQUE KEY `id` (`id`)
+  UNIQUE KEY `id` (`id`),
+  KEY `groups_realm_site_id_gid` (`realm`,`site_id`,`gid`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
@@ -128,6 +147,51 @@ CREATE TABLE `network` (
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `node_classification`
+--
+
+DROP TABLE IF EXISTS `node_classification`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `node_classification` (
+  `hostname` varchar(200) NOT NULL,
+  `realm` varchar(10) NOT NULL,
+  `site_id` varchar(3) NOT NULL,
+  `cfg_digest` varchar(32) DEFAULT NULL,
+  `yaml` text,
+  PRIMARY KEY (`hostname`,`realm`,`site_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `id_allocation`
+--
+
+DROP TABLE IF EXISTS `id_allocation`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `id_allocation` (
+  `kind` varchar(3) NOT NULL,
+  `realm` varchar(10) NOT NULL,
+  `site_id` varchar(3) NOT NULL,
+  PRIMARY KEY (`kind`,`realm`,`site_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `vlan_lock`
+--
+
+DROP TABLE IF EXISTS `vlan_lock`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `vlan_lock` (
+  `vlan` int(11) NOT NULL,
+  PRIMARY KEY (`vlan`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `tags`
 --
@@ -250,7 +314,8 @@ CREATE TABLE `users` (
   `active` tinyint(1) DEFAULT '1',
   `email` varchar(100) DEFAULT NULL,
   UNIQUE KEY `id` (`id`),
-  PRIMARY KEY (`username`,`realm`,`site_id`)
+  PRIMARY KEY (`username`,`realm`,`site_id`),
+  KEY `users_realm_site_id_uid` (`realm`,`site_id`,`uid`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
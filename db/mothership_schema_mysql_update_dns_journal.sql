@@ -0,0 +1,9 @@
+CREATE TABLE `dns_journal` (
+  `id` bigint(20) unsigned NOT NULL AUTO_INCREMENT,
+  `realm` varchar(10) DEFAULT NULL,
+  `site_id` varchar(3) DEFAULT NULL,
+  `interface` varchar(15) DEFAULT NULL,
+  `zone` varchar(100) DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `id` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
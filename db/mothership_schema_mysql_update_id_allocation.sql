@@ -0,0 +1,9 @@
+CREATE TABLE `id_allocation` (
+  `kind` varchar(3) NOT NULL,
+  `realm` varchar(10) NOT NULL,
+  `site_id` varchar(3) NOT NULL,
+  PRIMARY KEY (`kind`,`realm`,`site_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+ALTER TABLE `groups` ADD KEY `groups_realm_site_id_gid` (`realm`,`site_id`,`gid`);
+ALTER TABLE `users` ADD KEY `users_realm_site_id_uid` (`realm`,`site_id`,`uid`);
@@ -0,0 +1,8 @@
+CREATE TABLE `node_classification` (
+  `hostname` varchar(200) NOT NULL,
+  `realm` varchar(10) NOT NULL,
+  `site_id` varchar(3) NOT NULL,
+  `cfg_digest` varchar(32) DEFAULT NULL,
+  `yaml` text,
+  PRIMARY KEY (`hostname`,`realm`,`site_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
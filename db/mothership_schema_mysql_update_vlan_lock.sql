@@ -0,0 +1,4 @@
+CREATE TABLE `vlan_lock` (
+  `vlan` int(11) NOT NULL,
+  PRIMARY KEY (`vlan`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
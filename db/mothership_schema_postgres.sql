@@ -52,6 +52,42 @@ ALTER TABLE public.dns_addendum_id_seq OWNER TO mothership;
 ALTER SEQUENCE dns_addendum_id_seq OWNED BY dns_addendum.id;
 
 
+--
+-- Name: dns_journal; Type: TABLE; Schema: public; Owner: mothership; Tablespace: 
+--
+
+CREATE TABLE dns_journal (
+    id integer NOT NULL,
+    realm character varying(10),
+    site_id character varying(3),
+    interface character varying(15),
+    zone character varying(100)
+);
+
+
+ALTER TABLE public.dns_journal OWNER TO mothership;
+
+--
+-- Name: dns_journal_id_seq; Type: SEQUENCE; Schema: public; Owner: mothership
+--
+
+CREATE SEQUENCE dns_journal_id_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MAXVALUE
+    NO MINVALUE
+    CACHE 1;
+
+
+ALTER TABLE public.dns_journal_id_seq OWNER TO mothership;
+
+--
+-- Name: dns_journal_id_seq; Type: SEQUENCE OWNED BY; Schema: public; Owner: mothership
+--
+
+ALTER SEQUENCE dns_journal_id_seq OWNED BY dns_journal.id;
+
+
 --
 -- Name: groups; Type: TABLE; Schema: public; Owner: mothership; Tablespace: 
 --
@@ -215,6 +251,48 @@ ALTER TABLE public.network_id_seq OWNER TO mothership;
 ALTER SEQUENCE network_id_seq OWNED BY network.id;
 
 
+--
+-- Name: node_classification; Type: TABLE; Schema: public; Owner: mothership; Tablespace: 
+--
+
+CREATE TABLE node_classification (
+    hostname character varying(200) NOT NULL,
+    realm character varying(10) NOT NULL,
+    site_id character varying(3) NOT NULL,
+    cfg_digest character varying(32),
+    yaml text
+);
+
+
+ALTER TABLE public.node_classification OWNER TO mothership;
+
+
+--
+-- Name: id_allocation; Type: TABLE; Schema: public; Owner: mothership; Tablespace: 
+--
+
+CREATE TABLE id_allocation (
+    kind character varying(3) NOT NULL,
+    realm character varying(10) NOT NULL,
+    site_id character varying(3) NOT NULL
+);
+
+
+ALTER TABLE public.id_allocation OWNER TO mothership;
+
+
+--
+-- Name: vlan_lock; Type: TABLE; Schema: public; Owner: mothership; Tablespace: 
+--
+
+CREATE TABLE vlan_lock (
+    vlan integer NOT NULL
+);
+
+
+ALTER TABLE public.vlan_lock OWNER TO mothership;
+
+
 --
 -- Name: tags; Type: TABLE; Schema: public; Owner: postgres; Tablespace: 
 --
@@ -449,6 +527,13 @@ ALTER TABLE public.xen_pools OWNER TO mothership;
 ALTER TABLE dns_addendum ALTER COLUMN id SET DEFAULT nextval('dns_addendum_id_seq'::regclass);
 
 
+--
+-- Name: id; Type: DEFAULT; Schema: public; Owner: mothership
+--
+
+ALTER TABLE dns_journal ALTER COLUMN id SET DEFAULT nextval('dns_journal_id_seq'::regclass);
+
+
 --
 -- Name: id; Type: DEFAULT; Schema: public; Owner: mothership
 --
@@ -513,6 +598,14 @@ ALTER TABLE ONLY dns_addendum
     ADD CONSTRAINT dns_addendum_pkey PRIMARY KEY (id);
 
 
+--
+-- Name: dns_journal_pkey; Type: CONSTRAINT; Schema: public; Owner: mothership; Tablespace: 
+--
+
+ALTER TABLE ONLY dns_journal
+    ADD CONSTRAINT dns_journal_pkey PRIMARY KEY (id);
+
+
 --
 -- Name: group_realm_site_id; Type: CONSTRAINT; Schema: public; Owner: mothership; Tablespace: 
 --
@@ -561,6 +654,30 @@ ALTER TABLE ONLY network
     ADD CONSTRAINT network_pkey PRIMARY KEY (id);
 
 
+--
+-- Name: node_classification_pkey; Type: CONSTRAINT; Schema: public; Owner: mothership; Tablespace: 
+--
+
+ALTER TABLE ONLY node_classification
+    ADD CONSTRAINT node_classification_pkey PRIMARY KEY (hostname, realm, site_id);
+
+
+--
+-- Name: id_allocation_pkey; Type: CONSTRAINT; Schema: public; Owner: mothership; Tablespace: 
+--
+
+ALTER TABLE ONLY id_allocation
+    ADD CONSTRAINT id_allocation_pkey PRIMARY KEY (kind, realm, site_id);
+
+
+--
+-- Name: vlan_lock_pkey; Type: CONSTRAINT; Schema: public; Owner: mothership; Tablespace: 
+--
+
+ALTER TABLE ONLY vlan_lock
+    ADD CONSTRAINT vlan_lock_pkey PRIMARY KEY (vlan);
+
+
 --
 -- Name: tags_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres; Tablespace: 
 --
@@ -617,6 +734,20 @@ ALTER TABLE ONLY xen_pools
     ADD CONSTRAINT xen_pools_pkey PRIMARY KEY (server_id);
 
 
+--
+-- Name: groups_realm_site_id_gid; Type: INDEX; Schema: public; Owner: mothership; Tablespace: 
+--
+
+CREATE INDEX groups_realm_site_id_gid ON groups USING btree (realm, site_id, gid);
+
+
+--
+-- Name: users_realm_site_id_uid; Type: INDEX; Schema: public; Owner: mothership; Tablespace: 
+--
+
+CREATE INDEX users_realm_site_id_uid ON users USING btree (realm, site_id, uid);
+
+
 --
 -- Name: user_group_mapping_groups_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: mothership
 --
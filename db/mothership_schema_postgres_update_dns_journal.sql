@@ -0,0 +1,49 @@
+--
+-- Name: dns_journal; Type: TABLE; Schema: public; Owner: mothership; Tablespace: 
+--
+
+CREATE TABLE dns_journal (
+    id integer NOT NULL,
+    realm character varying(10),
+    site_id character varying(3),
+    interface character varying(15),
+    zone character varying(100)
+);
+
+
+ALTER TABLE public.dns_journal OWNER TO mothership;
+
+--
+-- Name: dns_journal_id_seq; Type: SEQUENCE; Schema: public; Owner: mothership
+--
+
+CREATE SEQUENCE dns_journal_id_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MAXVALUE
+    NO MINVALUE
+    CACHE 1;
+
+
+ALTER TABLE public.dns_journal_id_seq OWNER TO mothership;
+
+--
+-- Name: dns_journal_id_seq; Type: SEQUENCE OWNED BY; Schema: public; Owner: mothership
+--
+
+ALTER SEQUENCE dns_journal_id_seq OWNED BY dns_journal.id;
+
+
+--
+-- Name: id; Type: DEFAULT; Schema: public; Owner: mothership
+--
+
+ALTER TABLE dns_journal ALTER COLUMN id SET DEFAULT nextval('dns_journal_id_seq'::regclass);
+
+
+--
+-- Name: dns_journal_pkey; Type: CONSTRAINT; Schema: public; Owner: mothership; Tablespace: 
+--
+
+ALTER TABLE ONLY dns_journal
+    ADD CONSTRAINT dns_journal_pkey PRIMARY KEY (id);
@@ -0,0 +1,34 @@
+--
+-- Name: id_allocation; Type: TABLE; Schema: public; Owner: mothership; Tablespace: 
+--
+
+CREATE TABLE id_allocation (
+    kind character varying(3) NOT NULL,
+    realm character varying(10) NOT NULL,
+    site_id character varying(3) NOT NULL
+);
+
+
+ALTER TABLE public.id_allocation OWNER TO mothership;
+
+
+--
+-- Name: id_allocation_pkey; Type: CONSTRAINT; Schema: public; Owner: mothership; Tablespace: 
+--
+
+ALTER TABLE ONLY id_allocation
+    ADD CONSTRAINT id_allocation_pkey PRIMARY KEY (kind, realm, site_id);
+
+
+--
+-- Name: groups_realm_site_id_gid; Type: INDEX; Schema: public; Owner: mothership; Tablespace: 
+--
+
+CREATE INDEX groups_realm_site_id_gid ON groups USING btree (realm, site_id, gid);
+
+
+--
+-- Name: users_realm_site_id_uid; Type: INDEX; Schema: public; Owner: mothership; Tablespace: 
+--
+
+CREATE INDEX users_realm_site_id_uid ON users USING btree (realm, site_id, uid);
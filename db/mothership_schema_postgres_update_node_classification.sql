@@ -0,0 +1,22 @@
+--
+-- Name: node_classification; Type: TABLE; Schema: public; Owner: mothership; Tablespace: 
+--
+
+CREATE TABLE node_classification (
+    hostname character varying(200) NOT NULL,
+    realm character varying(10) NOT NULL,
+    site_id character varying(3) NOT NULL,
+    cfg_digest character varying(32),
+    yaml text
+);
+
+
+ALTER TABLE public.node_classification OWNER TO mothership;
+
+
+--
+-- Name: node_classification_pkey; Type: CONSTRAINT; Schema: public; Owner: mothership; Tablespace: 
+--
+
+ALTER TABLE ONLY node_classification
+    ADD CONSTRAINT node_classification_pkey PRIMARY KEY (hostname, realm, site_id);
@@ -0,0 +1,18 @@
+--
+-- Name: vlan_lock; Type: TABLE; Schema: public; Owner: mothership; Tablespace: 
+--
+
+CREATE TABLE vlan_lock (
+    vlan integer NOT NULL
+);
+
+
+ALTER TABLE public.vlan_lock OWNER TO mothership;
+
+
+--
+-- Name: vlan_lock_pkey; Type: CONSTRAINT; Schema: public; Owner: mothership; Tablespace: 
+--
+
+ALTER TABLE ONLY vlan_lock
+    ADD CONSTRAINT vlan_lock_pkey PRIMARY KEY (vlan);
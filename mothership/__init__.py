@@ -30,6 +30,7 @@ import mothership.validate
 
 from mothership.mothership_models import *
 from sqlalchemy import or_, desc, MetaData
+from sqlalchemy.exc import IntegrityError
 
 
 # Mothership's main exception type
@@ -37,6 +38,34 @@ class MothershipError(Exception):
     pass
 
 
+class LazyModule(object):
+    """
+        Stands in for a mothership subsystem until something uses it.
+        The first attribute lookup imports the real module, which then
+        replaces this placeholder as mothership.<name>
+    """
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+
+    def __getattr__(self, attr):
+        module = __import__(self._name, globals(), locals(), [attr])
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return "<lazy module '%s'>" % self._name
+
+# subsystems that pull in third party libraries (XenAPI, python-ldap,
+# pexpect, xmlrpclib, zabbix_api2, snmp tools) or are only needed by a
+# handful of ship commands. "mothership.xen.foo()" works without an
+# "import mothership.xen", and only pays for the import when it runs
+lazy_subsystems = ['cobbler', 'dns', 'idrac6', 'ldap', 'mgmt_vlan', 'probe',
+                   'puppet', 'serverinfo', 'snmp', 'xen', 'zabbix', 'zenoss']
+for subsystem in lazy_subsystems:
+    if 'mothership.' + subsystem not in sys.modules:
+        globals()[subsystem] = LazyModule('mothership.' + subsystem)
+del subsystem
+
+
 # Add a tag
 def add_tag(cfg, name, start_port=None, stop_port=None, security_level=None):
     badtag = cfg.dbsess.query(Tag).\
@@ -108,39 +137,114 @@ def calculate_last_virtual_ipaddress(cfg, vlan):
         ip,site_id = mothership.network_mapper.remap(cfg, ['1st_dyn_ip','siteid'], vlan=int(vlan))
         return ip, 'prod', site_id
 
-def calculate_next_baremetal_vlan_ipaddress(cfg, vlan):
-    data = cfg.dbsess.query(Network).\
+class VlanAllocator(object):
+    """
+        Occupancy bitmap of the addresses first..last (dotted quads) of
+        a vlan, one bit per address. Handing out free addresses walks
+        the bitmap forward from a cursor, so taking n of them costs
+        O(range) in total rather than a scan of the used list per try
+    """
+    def __init__(self, first, last, used=()):
+        self.base = mothership.network_mapper.ip2long(first)
+        self.size = max(mothership.network_mapper.ip2long(last) - self.base + 1, 0)
+        self.bits = bytearray((self.size + 7) / 8)
+        self.cursor = 0
+        for ip in used:
+            self.mark(ip)
+
+    def _offset(self, ip):
+        offset = mothership.network_mapper.ip2long(ip) - self.base
+        if 0 <= offset < self.size:
+            return offset
+        return None
+
+    def mark(self, ip):
+        """
+            Record ip as used, addresses outside the range are ignored
+        """
+        offset = self._offset(ip)
+        if offset is not None:
+            self.bits[offset >> 3] |= 1 << (offset & 7)
+
+    def used(self, ip):
+        offset = self._offset(ip)
+        return offset is not None and bool(self.bits[offset >> 3] & (1 << (offset & 7)))
+
+    def iter_free(self):
+        """
+            Yields the unused addresses in order, marking each one used
+            as it is handed out. Whole bytes of used addresses are
+            skipped at once
+        """
+        while self.cursor < self.size:
+            offset = self.cursor
+            if self.bits[offset >> 3] == 0xff:
+                self.cursor = ((offset >> 3) + 1) << 3
+                continue
+            self.cursor += 1
+            if not self.bits[offset >> 3] & (1 << (offset & 7)):
+                self.bits[offset >> 3] |= 1 << (offset & 7)
+                yield mothership.network_mapper.long2ip(self.base + offset)
+
+def lock_vlan(cfg, vlan):
+    """
+        Lock the vlan_lock row of vlan (SELECT ... FOR UPDATE) until the
+        session commits, so concurrent allocations in the same vlan
+        take turns, even in a vlan with no network rows yet. The row
+        is created the first time. Returns the (ip, hw_tag) of the
+        vlan's rows with an ip, read after the lock is held so they
+        include whatever the previous holder committed
+    """
+    for attempt in range(2):
+        if cfg.dbsess.query(VlanLock).\
+            filter(VlanLock.vlan==int(vlan)).\
+            with_lockmode('update').first():
+            break
+        # the inserted row stays locked until the commit too
+        cfg.dbsess.add(VlanLock(int(vlan)))
+        try:
+            cfg.dbsess.flush()
+            break
+        except IntegrityError:
+            # somebody else created it first, wait for their lock
+            cfg.dbsess.rollback()
+    else:
+        raise MothershipError("Unable to lock vlan %s for ip allocation" % vlan)
+    return cfg.dbsess.query(Network.ip, Network.hw_tag).\
         filter(Network.vlan==vlan).\
-        filter(Network.ip!=cfg.dbnull).\
-        filter(Network.hw_tag!=cfg.dbnull)
+        filter(Network.ip!=cfg.dbnull).all()
+
+def calculate_next_baremetal_vlan_ipaddress(cfg, vlan):
+    """
+        The next free baremetal ip in vlan: the first address between
+        the vlan's 1st_static_ip (or its lowest baremetal ip) and its
+        highest baremetal ip that no network row has and that doesn't
+        answer a probe, else the address after the highest one.
+        The vlan stays locked until the caller commits the row it
+        puts the ip on, see lock_vlan()
+    """
+    ip2long = mothership.network_mapper.ip2long
     lowest = mothership.network_mapper.remap(cfg, '1st_static_ip', vlan=int(vlan))
-    try:
-        first = data.order_by(Network.ip).first().ip
-        last = data.order_by(Network.ip.desc()).first().ip
-        #print 'RANGE: %s - %s' % (first, last)
-    except Exception, e:
+    rows = lock_vlan(cfg, vlan)
+    # the range is bounded by the baremetal (hw_tag) rows, every row
+    # of the vlan counts as taken
+    used = [ip for (ip, hw_tag) in rows]
+    baremetal = [ip for (ip, hw_tag) in rows if hw_tag]
+    if baremetal:
+        longs = [ip2long(ip) for ip in baremetal]
+        first = mothership.network_mapper.long2ip(min(longs))
+        last = mothership.network_mapper.long2ip(max(longs))
+    else:
         first = lowest
         last = first
-    if first < lowest:
+    if ip2long(first) < ip2long(lowest):
         first = lowest
-
-    # compare the sequential list to the shiplist
-    shiplist = []
-    for i in data.order_by(Network.ip).all():
-        shiplist.append(i.ip)
+    if ip2long(last) < ip2long(first):
+        last = first
 
     # determine the next free ip and return it
-    nextip = None
-    for i in mothership.network_mapper.generate_ipaddress_list(first, last=last):
-        if i not in shiplist:
-            pingcheck = os.popen("ping -q -c2 -t2 "+i,"r")
-            while 1:
-                line = pingcheck.readline()
-                if not line: break
-                match = re.findall(re.compile(r"(\d)( packets)? received"),line)
-                if match:
-                    if int(match[0][0]) == 0:
-                        return i
+    allocator = VlanAllocator(first, last, used)
+    nextip = mothership.probe.first_free(cfg, allocator.iter_free())
     if not nextip:
         nextip = mothership.network_mapper.next_ip(last)
     return nextip
@@ -313,18 +417,75 @@ def snh(cfg, host, realm, site_id):
     else:
         return None
 
-def generate_ipaddress_range(cfg, first, count=None, last=None, realm=None, site_id=None):
+def generate_ipaddress_range(cfg, first, count=None, last=None, realm=None, site_id=None, bulk=False):
     """
        Generates all the ip addresses between first and last ip specified
        determines the vlan, netmask and interface and inserts into network
        e.g. generate_ips('10.50.50.15','10.50.50.30')
+       With bulk=True, addresses that already have a network row are
+       skipped instead of updated, and the new rows go in with a single
+       insert, see insert_network_rows()
     """
-    for ip in mothership.network_mapper.generate_ipaddress_list(first, count=count, last=last):
-        vlan, netmask, interface = mothership.network_mapper.remap(cfg,
-            ['vlan','mask','nic'], ip=ip, siteid=site_id)
+    ips = list(mothership.network_mapper.iter_ipaddress_range(first, count=count, last=last))
+    lines = mothership.network_mapper.classify_ips(cfg, ips, siteid=site_id)
+    rows = []
+    for ip, line in zip(ips, lines):
+        if not line:
+            raise MothershipError("%s is not in any network of site %s, aborting" % (ip, site_id))
+        vlan = line.get('vlan')
+        interface = line.get('nic')
+        netmask = None
+        if 'cidr' in line:
+            netmask = mothership.network_mapper.get_netmask(line['cidr'])
         mac = mothership.network_mapper.ip_to_mac(ip)
-        update_table_network(cfg, { 'ip':ip, 'realm':realm, 'site_id':site_id,
+        rows.append({ 'ip':ip, 'realm':realm, 'site_id':site_id,
             'mac':mac, 'vlan':vlan, 'netmask':netmask, 'interface':interface })
+    if bulk:
+        inserted, skipped = insert_network_rows(cfg, rows)
+        print 'Inserted %d network rows, skipped %d that already exist' % (inserted, skipped)
+        return inserted, skipped
+    for row in rows:
+        update_table_network(cfg, row)
+
+def insert_network_rows(cfg, rows):
+    """
+       Inserts the network rows (dicts of Network columns, all with the
+       same keys) that don't exist yet, in one transaction with a single
+       executemany. A row exists if a row on its interface has its mac
+       or its ip, the same test update_table_network() uses. Existing
+       rows are looked up with IN queries, a chunk of addresses at a time.
+       Returns (inserted, skipped)
+    """
+    chunk = 1000
+    existing = set()
+    for i in range(0, len(rows), chunk):
+        ips = [r['ip'] for r in rows[i:i+chunk] if r.get('ip')]
+        macs = [r['mac'] for r in rows[i:i+chunk] if r.get('mac')]
+        clauses = []
+        if ips:
+            clauses.append(Network.ip.in_(ips))
+        if macs:
+            clauses.append(Network.mac.in_(macs))
+        if not clauses:
+            continue
+        for n in cfg.dbsess.query(Network.interface, Network.ip, Network.mac).\
+            filter(or_(*clauses)).all():
+            existing.add((n.interface, 'ip', n.ip))
+            existing.add((n.interface, 'mac', n.mac))
+    new = []
+    for r in rows:
+        if (r['interface'], 'mac', r.get('mac')) in existing or \
+           (r['interface'], 'ip', r.get('ip')) in existing:
+            continue
+        new.append(r)
+    if new:
+        try:
+            cfg.dbconn.execute(Network.__table__.insert(), new)
+            cfg.dbsess.commit()
+        except:
+            cfg.dbsess.rollback()
+            raise
+    return len(new), len(rows) - len(new)
 
 def import_multiple_table_info(cfg, info, when):
     sid = None
@@ -814,22 +975,17 @@ def retrieve_network_rows(cfg, hwtag=None, serverid=None):
     return data.all()
 
 def retrieve_next_virtual_ip(cfg, vlan, autogen=False):
-    for next in cfg.dbsess.query(Network).\
+    candidates = (n.ip for n in cfg.dbsess.query(Network).\
         filter(Network.server_id==cfg.dbnull).\
         filter(Network.hw_tag==cfg.dbnull).\
         filter(Network.vlan==vlan).\
-        order_by(Network.ip).all():
-        pingcheck = os.popen("ping -q -c2 -t2 "+next.ip,"r")
-        while 1:
-            line = pingcheck.readline()
-            if not line: break
-            match = re.findall(re.compile(r"(\d)( packets)? received"),line)
-            if match:
-                if int(match[0][0]) == 0:
-                    return next.ip
+        order_by(Network.ip).all())
+    nextip = mothership.probe.first_free(cfg, candidates)
+    if nextip:
+        return nextip
     if autogen:
         ip,realm,site_id = calculate_last_virtual_ipaddress(cfg, vlan)
-        generate_ipaddress_range(cfg, ip, count=5, realm=realm, site_id=site_id)
+        generate_ipaddress_range(cfg, ip, count=5, realm=realm, site_id=site_id, bulk=True)
         return cfg.dbsess.query(Network).\
             filter(Network.server_id==cfg.dbnull).\
             filter(Network.hw_tag==cfg.dbnull).\
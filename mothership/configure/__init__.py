@@ -18,12 +18,13 @@
 """
 import os.path
 import sys
+import copy
 import shutil
 import yaml
 
 # Extra modules
-import xmlrpclib
 import sqlalchemy
+import sqlalchemy.orm
 
 # our error class
 class ConfigureError(Exception):
@@ -33,7 +34,7 @@ class ConfigureError(Exception):
 # a config_file (mothership.yaml)
 load_paths = ['.', '~', '/etc', '/usr/local/etc']
 
-class Configure:
+class Configure(object):
     def __init__(self, config_file):
         """
             Takes a config_file name as a parameter and searches through the following
@@ -54,30 +55,22 @@ class Configure:
             raise ConfigureError("Config file mothership.yaml not found in path: %s" % load_paths)
 
         # Database related settings
+        # the engine, session and connection are not created here, they
+        # are built the first time something asks for them (see dbengine,
+        # dbsess and dbconn below) so commands that never touch the db
+        # don't pay for a connection
         dbconfig = all_configs['db']
-        try:
-            engine = ''
-            # PostgreSQL
-            if dbconfig['engine'] == 'postgresql':
-                dbtuple = (dbconfig['user'], dbconfig['hostname'], dbconfig['dbname'])
-                engine = sqlalchemy.create_engine("postgres://%s@%s/%s" % dbtuple, echo=dbconfig['echo'])
-            # MySql
-            elif dbconfig['engine'] == 'mysql':
-                dbtuple = (dbconfig['user'], dbconfig['pass'], dbconfig['hostname'], dbconfig['dbname'])
-                engine = sqlalchemy.create_engine("mysql://%s:%s@%s/%s" % dbtuple, echo=dbconfig['echo'])
-            # uhhhh....
-            else:
-                raise ConfigureError("DB section of /etc/mothership.yaml is misconfigured! Exiting")
-            Session = sqlalchemy.orm.sessionmaker(bind=engine)
-            dbsession = Session()
-            self.dbconfig = dbconfig
-            self.dbconn = engine.connect()
-            self.dbengine = engine
-            self.dbsess = dbsession
-            self.dbnull = sqlalchemy.sql.expression.null()
-        except:
-            print "dbtuple: %s\nengine: %s" % (dbtuple, engine)
-            raise ConfigureError('Database configuration error')
+        if dbconfig.get('engine') not in ['postgresql', 'mysql', 'sqlite']:
+            raise ConfigureError("DB section of /etc/mothership.yaml is misconfigured! Exiting")
+        self.dbconfig = dbconfig
+        self._dbengine = None
+        self._dbsess = None
+        # a sqlalchemy ConnectionProxy to install on the engine when it
+        # is made, ship_benchmark counts queries with one
+        self.dbproxy = None
+        self.dbnull = sqlalchemy.sql.expression.null()
+        # remote api handles (cobbler, etc) are also made on demand
+        self._cobbler_handles = {}
 
         # Cobbler related settings
         self.cobconfig = all_configs['cobbler']
@@ -149,6 +142,12 @@ class Configure:
             self.search_path = kvconfig['search_path']
         else:
             self.search_path = [ ['prod', 'iad'], ['iad'], [] ]
+        # 0 is a valid ttl (no caching), so don't test for truth
+        if 'cache_ttl' in kvconfig and kvconfig['cache_ttl'] is not None:
+            self.kv_cache_ttl = int(kvconfig['cache_ttl'])
+        else:
+            self.kv_cache_ttl = 30
+        self._kvcache = None
 
         # Zenoss settings
         zenconfig = all_configs['zenoss']
@@ -354,14 +353,190 @@ class Configure:
             self.dns_expire = dnsconfig['expire']
         else:
             self.dns_expire = '604800'
+        if 'checkzone' in dnsconfig and dnsconfig['checkzone']:
+            self.dns_checkzone = dnsconfig['checkzone']
+        else:
+            self.dns_checkzone = '/usr/sbin/named-checkzone'
+        if 'check_workers' in dnsconfig and dnsconfig['check_workers']:
+            self.dns_check_workers = int(dnsconfig['check_workers'])
+        else:
+            self.dns_check_workers = 8
+
+        # liveness probe settings, for picking free ips
+        probeconfig = all_configs.get('probe') or {}
+        if 'backend' in probeconfig and probeconfig['backend']:
+            self.probe_backend = probeconfig['backend']
+        else:
+            self.probe_backend = 'icmp'
+        if 'timeout' in probeconfig and probeconfig['timeout']:
+            self.probe_timeout = int(probeconfig['timeout'])
+        else:
+            self.probe_timeout = 2
+        if 'count' in probeconfig and probeconfig['count']:
+            self.probe_count = int(probeconfig['count'])
+        else:
+            self.probe_count = 2
+        if 'workers' in probeconfig and probeconfig['workers']:
+            self.probe_workers = int(probeconfig['workers'])
+        else:
+            self.probe_workers = 16
+
+        # shipd (persistent ship daemon) settings
+        shipdconfig = all_configs.get('shipd') or {}
+        if 'socket' in shipdconfig and shipdconfig['socket']:
+            self.shipd_socket = shipdconfig['socket']
+        else:
+            self.shipd_socket = '/var/run/mothership/shipd.sock'
+        if 'socket_mode' in shipdconfig and shipdconfig['socket_mode']:
+            # quoted in the yaml so it is read as octal, not decimal
+            if isinstance(shipdconfig['socket_mode'], basestring):
+                self.shipd_socket_mode = int(shipdconfig['socket_mode'], 8)
+            else:
+                self.shipd_socket_mode = shipdconfig['socket_mode']
+        else:
+            self.shipd_socket_mode = 0666
+        if 'commands' in shipdconfig and shipdconfig['commands']:
+            self.shipd_commands = shipdconfig['commands']
+        else:
+            self.shipd_commands = ['classify', 'classify_site', 'keyvalues', 'list_servers',
+                'serverinfo', 'list_all_values', 'display_users',
+                'group_display', 'gen_sudoers_groups', 'version', 'help']
+
+        # ship_enc (http puppet node classifier) settings
+        encconfig = all_configs.get('enc') or {}
+        if 'address' in encconfig and encconfig['address']:
+            self.enc_address = encconfig['address']
+        else:
+            self.enc_address = '0.0.0.0'
+        if 'port' in encconfig and encconfig['port']:
+            self.enc_port = int(encconfig['port'])
+        else:
+            self.enc_port = 8180
+        if 'workers' in encconfig and encconfig['workers']:
+            self.enc_workers = int(encconfig['workers'])
+        else:
+            self.enc_workers = 8
+        if 'backlog' in encconfig and encconfig['backlog']:
+            self.enc_backlog = int(encconfig['backlog'])
+        else:
+            self.enc_backlog = 128
+        if 'cache_ttl' in encconfig and encconfig['cache_ttl'] is not None:
+            self.enc_cache_ttl = int(encconfig['cache_ttl'])
+        else:
+            self.enc_cache_ttl = 10
+
+    def _get_dbengine(self):
+        """
+            Create the sqlalchemy engine (and its connection pool)
+            the first time it is needed
+        """
+        if self._dbengine is None:
+            dbconfig = self.dbconfig
+            dbtuple = None
+            try:
+                # PostgreSQL
+                if dbconfig['engine'] == 'postgresql':
+                    dbtuple = (dbconfig['user'], dbconfig['hostname'], dbconfig['dbname'])
+                    self._dbengine = sqlalchemy.create_engine("postgres://%s@%s/%s" % dbtuple, echo=dbconfig['echo'], proxy=self.dbproxy)
+                # MySql
+                elif dbconfig['engine'] == 'mysql':
+                    dbtuple = (dbconfig['user'], dbconfig['pass'], dbconfig['hostname'], dbconfig['dbname'])
+                    self._dbengine = sqlalchemy.create_engine("mysql://%s:%s@%s/%s" % dbtuple, echo=dbconfig['echo'], proxy=self.dbproxy)
+                # SQLite, dbname is the path to the database file
+                elif dbconfig['engine'] == 'sqlite':
+                    dbtuple = (dbconfig['dbname'],)
+                    self._dbengine = sqlalchemy.create_engine("sqlite:///%s" % dbtuple, echo=dbconfig['echo'], proxy=self.dbproxy)
+            except:
+                print "dbtuple: %s\nengine: %s" % (dbtuple, dbconfig['engine'])
+                raise ConfigureError('Database configuration error')
+        return self._dbengine
+    dbengine = property(_get_dbengine)
+
+    def _get_dbsess(self):
+        """
+            Create the session on first use, bound to the shared engine.
+            The session records the dns zones its writes touch in the
+            dns journal (see mothership.dns_journal), and drops the
+            puppet classifications they change (see mothership.node_cache)
+        """
+        if self._dbsess is None:
+            import mothership.dns_journal
+            import mothership.node_cache
+            Session = sqlalchemy.orm.sessionmaker(bind=self.dbengine,
+                extension=[mothership.dns_journal.JournalExtension(self),
+                           mothership.node_cache.CacheExtension()])
+            self._dbsess = Session()
+        return self._dbsess
+    dbsess = property(_get_dbsess)
+
+    def _get_dbconn(self):
+        """
+            The raw connection is the one the session is already using,
+            so raw statements and orm queries share a single pooled
+            connection (and transaction) instead of opening two
+        """
+        return self.dbsess.connection()
+    dbconn = property(_get_dbconn)
+
+    def _get_kvcache(self):
+        """
+            The KV lookup cache (see mothership.kv.KVCache), made the
+            first time a KV is looked up
+        """
+        if self._kvcache is None:
+            import mothership.kv
+            self._kvcache = mothership.kv.KVCache(self.kv_cache_ttl)
+        return self._kvcache
+    kvcache = property(_get_kvcache)
+
+    def cobbler_api(self, site_id=None):
+        """
+            Returns the CobblerAPI handle for site_id, logging in to
+            cobbler only the first time a handle for that site is needed
+        """
+        if site_id not in self._cobbler_handles:
+            import mothership.cobbler
+            self._cobbler_handles[site_id] = mothership.cobbler.CobblerAPI(self, site_id=site_id)
+        return self._cobbler_handles[site_id]
 
     def close_connections(self):
         """
-            Close out connections
+            Close out connections, only if they were ever opened.
+            They will be recreated on demand if used again
+        """
+        self._cobbler_handles = {}
+        if self._dbsess is not None:
+            self._dbsess.close()
+            self._dbsess = None
+        if self._dbengine is not None:
+            self._dbengine.dispose()
+            self._dbengine = None
+
+    def forget_connections(self):
+        """
+            For a forked child: stop using the connections inherited
+            from the parent, without closing them (closing would hang
+            up the parent's connections too). They are kept referenced
+            so they are never garbage collected in the child, and new
+            ones are made on demand
+        """
+        self._inherited_handles = (self._dbsess, self._dbengine, self._cobbler_handles)
+        self._cobbler_handles = {}
+        self._dbsess = None
+        self._dbengine = None
+
+    def thread_copy(self):
+        """
+            A copy of the configuration for another thread. It shares
+            the engine, and so its connection pool, but makes its own
+            session and KV cache
         """
-        self.dbconn.close()
-        self.dbsess.close()
-        self.dbengine.dispose()
+        self.dbengine
+        cfg = copy.copy(self)
+        cfg._dbsess = None
+        cfg._kvcache = None
+        cfg._cobbler_handles = {}
+        return cfg
 
     def load_path(self, config_file):
         """
@@ -20,11 +20,18 @@ import re
 import os
 import sys
 import time
+import hashlib
 import shutil
+import signal
 import difflib
+import tempfile
 import datetime
+import threading
+import subprocess
+import Queue
 import mothership.kv
 import mothership.validate
+import mothership.dns_journal
 import mothership.network_mapper
 from mothership.mothership_models import *
 
@@ -120,124 +127,123 @@ to configure one or more %s
     return records
 
 
-# generates arecords. badly.
+def iter_dns_arecords(cfg, realm, site_id, interface):
+    """
+    Yields the A records of every server with an ip on interface in
+    realm.site_id, from a single Network/Server join
+    """
+    for hostname, ip in cfg.dbsess.query(Server.hostname, Network.ip).\
+        filter(Network.server_id==Server.id).\
+        filter(Network.interface==interface).\
+        filter(Network.site_id==site_id).\
+        filter(Network.realm==realm).yield_per(1000):
+            if ip and hostname:
+                yield '%-20s\tIN\t%-8s%-16s\n' % (hostname, 'A', ip)
+
+
 def generate_dns_arecords(cfg, realm, site_id, drac=False, mgmt=False):
     """
     Retrieves server list from mothership to create A records
     """
-    alist = ''
     if not drac and not mgmt:
-        for n in cfg.dbsess.query(Network).\
-            filter(Network.interface==cfg.primary_interface).\
-            filter(Network.site_id==site_id).\
-            filter(Network.realm==realm).all():
-                if n.server_id:
-                    s = cfg.dbsess.query(Server).\
-                        filter(Server.id==n.server_id).first()
-                    if n.ip and s.hostname:
-                        alist += '%-20s\tIN\t%-8s%-16s\n' % (s.hostname, 'A', n.ip)
+        interface = cfg.primary_interface
     elif drac and not mgmt:
-        for n in cfg.dbsess.query(Network).\
-            filter(Network.interface=='drac').\
-            filter(Network.site_id==site_id).\
-            filter(Network.realm==realm).all():
-                if n.server_id:
-                    s = cfg.dbsess.query(Server).\
-                        filter(Server.id==n.server_id).first()
-                    if n.ip and s.hostname:
-                        alist += '%-20s\tIN\t%-8s%-16s\n' % (s.hostname, 'A', n.ip)
+        interface = 'drac'
     elif mgmt and cfg.mgmt_vlan_interface and not drac:
-        for n in cfg.dbsess.query(Network).\
-            filter(Network.interface==cfg.mgmt_vlan_interface).\
-            filter(Network.site_id==site_id).\
-            filter(Network.realm==realm).all():
-                if n.server_id:
-                    s = cfg.dbsess.query(Server).\
-                        filter(Server.id==n.server_id).first()
-                    if n.ip and s.hostname:
-                        alist += '%-20s\tIN\t%-8s%-16s\n' % (s.hostname, 'A', n.ip)
+        interface = cfg.mgmt_vlan_interface
     elif mgmt and drac:
         raise DNSError("massive problem in mothership code. pick either mgmt or drac in your generate_dns_arecords() call")
     else:
         print "dumping vars. realm: %s, site_id: %s, drac: %s, mgmt: %s" % (realm, site_id, drac, mgmt)
         raise DNSError("something has gone horribly wrong in generate_dns_arecords()")
-    return alist
+    return ''.join(iter_dns_arecords(cfg, realm, site_id, interface))
+
+
+def iter_arpa_records(cfg, rows, num, label=''):
+    """
+    Yields PTR records for rows of (ip, realm, site_id, hostname),
+    pointing at hostname.<label>realm.site_id.domain
+    """
+    for ip, realm, site_id, hostname in rows:
+        yield '%-20s\tIN\t%-8s%s.%s%s.%s.%s.\n' % (
+            '.'.join(reversed(ip.split('.')[-num:])),
+            'PTR', hostname, label, realm, site_id, cfg.domain)
+
+
+def format_arpa_records(cfg, rows, num, label=''):
+    """
+    PTR records for rows of (ip, realm, site_id, hostname), pointing
+    at hostname.<label>realm.site_id.domain
+    """
+    return ''.join(iter_arpa_records(cfg, rows, num, label))
+
+
+def bucket_arpa_rows(cfg, kinds):
+    """
+    kinds is a list of (interface, cidrs). Loads (ip, interface, realm,
+    site_id, hostname) for every server interface in one join, ordered
+    by ip, and files each row under every cidr of its interface that
+    contains it, using the sorted integer ranges of a NetworkMap.
+    Returns, per kind, a list of rows per cidr
+    """
+    interfaces = list(set([interface for interface, cidrs in kinds]))
+    maps = []
+    buckets = []
+    for interface, cidrs in kinds:
+        maps.append(mothership.network_mapper.NetworkMap([{'cidr': c} for c in cidrs]))
+        buckets.append([[] for c in cidrs])
+    for ip, interface, realm, site_id, hostname in cfg.dbsess.query(
+        Network.ip, Network.interface, Network.realm, Network.site_id,
+        Server.hostname).\
+        filter(Network.server_id==Server.id).\
+        filter(Network.interface.in_(interfaces)).\
+        order_by(Network.ip).yield_per(1000):
+        if not ip or not hostname:
+            continue
+        iplong = mothership.network_mapper.ip2long(ip)
+        for k, (kind_interface, cidrs) in enumerate(kinds):
+            if interface != kind_interface:
+                continue
+            for i in maps[k].lines_within(iplong):
+                buckets[k][i].append((ip, realm, site_id, hostname))
+    return buckets
+
+
+def generate_arpa(cfg, cidr, interface, label=''):
+    """
+    Retrieves server list from mothership to create the arpa records
+    of one cidr
+    """
+    net, num = mothership.network_mapper.get_arpa_network(cidr)
+    rows = bucket_arpa_rows(cfg, [(interface, [cidr])])[0][0]
+    return net, format_arpa_records(cfg, rows, num, label)
 
 
 def generate_regular_arpa(cfg, cidr):
     """
     Retrieves server list from mothership to create regular arpa records
     """
-    net = mothership.network_mapper.get_network(cidr)
-    num = 0
-    while re.search('\.0+$', net):
-        net = re.sub('\.0+$', '', net)
-        num += 1
-    alist = ''
-    for n in cfg.dbsess.query(Network).\
-        filter(Network.interface==cfg.primary_interface).\
-        order_by(Network.ip).all():
-        if n.server_id:
-            s = cfg.dbsess.query(Server).\
-                    filter(Server.id==n.server_id).first()
-            if mothership.network_mapper.within(n.ip, cidr) and n.ip and s.hostname:
-                alist += '%-20s\tIN\t%-8s%s.%s.%s.%s.\n' % (
-                    '.'.join(reversed(n.ip.split('.')[-num:])),
-                    'PTR', s.hostname, n.realm, n.site_id, cfg.domain)
-    return net, alist
+    return generate_arpa(cfg, cidr, cfg.primary_interface)
 
 
 def generate_mgmt_arpa(cfg, cidr):
     """
     Retrieves server list from mothership to create mgmt arpa records
     """
-    net = mothership.network_mapper.get_network(cidr)
-    num = 0
-    while re.search('\.0+$', net):
-        net = re.sub('\.0+$', '', net)
-        num += 1
-    alist = ''
-    for n in cfg.dbsess.query(Network).\
-        filter(Network.interface==cfg.mgmt_vlan_interface).\
-        order_by(Network.ip).all():
-        if n.server_id:
-            s = cfg.dbsess.query(Server).\
-                    filter(Server.id==n.server_id).first()
-            if mothership.network_mapper.within(n.ip, cidr) and n.ip and s.hostname:
-                alist += '%-20s\tIN\t%-8s%s.mgmt.%s.%s.%s.\n' % (
-                    '.'.join(reversed(n.ip.split('.')[-num:])),
-                    'PTR', s.hostname, n.realm, n.site_id, cfg.domain)
-    return net, alist
+    return generate_arpa(cfg, cidr, cfg.mgmt_vlan_interface, 'mgmt.')
 
 
 def generate_drac_arpa(cfg, cidr):
     """
     Retrieves server list from mothership to create drac arpa records
     """
-    net = mothership.network_mapper.get_network(cidr)
-    num = 0
-    while re.search('\.0+$', net):
-        net = re.sub('\.0+$', '', net)
-        num += 1
-    alist = ''
-    for n in cfg.dbsess.query(Network).\
-        filter(Network.interface=='drac').\
-        order_by(Network.ip).all():
-        if n.server_id:
-            s = cfg.dbsess.query(Server).\
-                    filter(Server.id==n.server_id).first()
-            if mothership.network_mapper.within(n.ip, cidr) and n.ip and s.hostname:
-                alist += '%-20s\tIN\t%-8s%s.drac.%s.%s.%s.\n' % (
-                    '.'.join(reversed(n.ip.split('.')[-num:])),
-                    'PTR', s.hostname, n.realm, n.site_id, cfg.domain)
-    return net, alist
+    return generate_arpa(cfg, cidr, 'drac', 'drac.')
 
 
-def generate_dns_addendum(cfg, realm, site_id):
+def iter_dns_addendum(cfg, realm, site_id):
     """
-    Turns the dns_addendum table into usable records
+    Yields the dns_addendum table as usable records
     """
-    alist = ''
     for dns in cfg.dbsess.query(DnsAddendum).\
         filter(DnsAddendum.site_id==site_id).\
         filter(DnsAddendum.realm==realm).\
@@ -249,13 +255,104 @@ def generate_dns_addendum(cfg, realm, site_id):
         if not re.search('\d+',dns.target.split('.')[-1]):
             if not target.endswith('.'):
                 target += '.'
-        alist += '%-20s\tIN\t%-8s%-16s\n' % (dns.host, dns.record_type, target)
-    return alist
+        yield '%-20s\tIN\t%-8s%-16s\n' % (dns.host, dns.record_type, target)
+
+
+def generate_dns_addendum(cfg, realm, site_id):
+    """
+    Turns the dns_addendum table into usable records
+    """
+    return ''.join(iter_dns_addendum(cfg, realm, site_id))
+
+
+def iter_zone(parts):
+    """
+    Yields the text of a zone given as a list of parts, each either
+    a string or an iterable of strings (a record generator)
+    """
+    for part in parts:
+        if isinstance(part, basestring):
+            yield part
+        else:
+            for chunk in part:
+                yield chunk
+
+
+def write_zone(path, parts):
+    """
+    Streams a zone (see iter_zone) into a temp file next to path, then
+    renames it into place, so the zone is never held in memory whole
+    and path never holds half a zone. Nothing is left behind if a
+    record generator fails
+    """
+    fd, tmp = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path),
+        dir=os.path.dirname(path) or '.')
+    f = os.fdopen(fd, 'w')
+    try:
+        for chunk in iter_zone(parts):
+            f.write(chunk)
+        f.close()
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+    except:
+        f.close()
+        os.unlink(tmp)
+        raise
+
+
+def print_zone(kind, name, parts):
+    """
+    Streams a zone (see iter_zone) to stdout under a banner
+    """
+    print '\n' + '-'*60 + '\nDNS %s zone for %s:\n' % (kind, name) + '-'*60
+    for chunk in iter_zone(parts):
+        sys.stdout.write(chunk)
+    sys.stdout.write('\n')
+
+
+def dirty_zones(cfg, journal, domain=None):
+    """
+    Turns journal rows into the zone files to rebuild: returns
+    (forward, reverse, rows), forward a dict of realm.site_id fqn ->
+    set of forward zone names, reverse a set of reverse zone names
+    (or the journal's "all" marker) and rows the journal rows those
+    cover. Only domain's forward zones are taken if domain is given
+    """
+    forward = {}
+    reverse = set()
+    rows = []
+    if domain:
+        domain = mothership.validate.v_get_fqn(cfg, domain)
+    for j in journal:
+        if j.zone:
+            reverse.add(j.zone)
+            rows.append(j)
+            continue
+        if j.realm not in cfg.realms or j.site_id not in cfg.site_ids:
+            # not a zone we generate
+            rows.append(j)
+            continue
+        fqn = '%s.%s.%s' % (j.realm, j.site_id, cfg.domain)
+        if domain and fqn != domain:
+            continue
+        rows.append(j)
+        names = forward.setdefault(fqn, set())
+        if j.interface in [None, cfg.primary_interface]:
+            names.add(fqn)
+        if j.interface in [None, cfg.mgmt_vlan_interface]:
+            names.add('mgmt.'+fqn)
+        if j.interface in [None, 'drac'] and cfg.drac:
+            names.add('drac.'+fqn)
+    if mothership.dns_journal.ALL in reverse:
+        reverse = mothership.dns_journal.ALL
+    return forward, reverse, rows
 
 
 def generate_dns_output(cfg, domain, opts):
     """
     Creates DNS zonefiles
+    With --system, only the zones the dns journal has changes for are
+    rebuilt and validated, unless --full is given
     """
     tmpdir = cfg.dns_tmpdir 
     zones = []
@@ -264,20 +361,33 @@ def generate_dns_output(cfg, domain, opts):
     if opts.outdir:
         if not os.path.exists(opts.outdir):
             os.makedirs(opts.outdir)
+    if opts.system and not getattr(opts, 'full', False):
+        return generate_dns_incremental(cfg, domain, opts)
+    if opts.system and opts.all:
+        # the journal rows this rebuild covers. Changes journaled while
+        # it runs may be missing from the zones, so they stay for the
+        # next run
+        done = mothership.dns_journal.pending(cfg)
     if opts.all:
         print 'Generating ALL mothership DNS files'
+        jobs = []
         for site_id in cfg.site_ids:
             for realm in cfg.realms:
                 fqn = mothership.validate.v_get_fqn(cfg, realm+'.'+site_id)
-                zones.extend(generate_dns_forward(cfg, fqn, opts))
-        revzones = generate_dns_reverse(cfg, opts)
+                jobs.append(('forward', fqn))
+        jobs.append(('reverse', None))
+        results = run_zone_jobs(cfg, opts, jobs)
+        for fwdzones in results[:-1]:
+            zones.extend(fwdzones or [])
+        revzones = results[-1]
         if revzones:
             zones.extend(revzones)
         else: 
             print "No reverse zones created"
     else:
-        zones.extend(generate_dns_forward(cfg, domain, opts))
-        revzones = generate_dns_reverse(cfg, opts)
+        fwdzones, revzones = run_zone_jobs(cfg, opts,
+            [('forward', domain), ('reverse', None)])
+        zones.extend(fwdzones or [])
         if revzones:
             zones.extend(revzones)
         else: 
@@ -288,14 +398,195 @@ def generate_dns_output(cfg, domain, opts):
         validate_zone_files(cfg, tmpdir, zones)
         if opts.all:
             validate_zone_config(cfg, tmpdir, zones)
+            mothership.dns_journal.clear(cfg, done)
         print "All zones validated. Please restart named so the changes can take effect."
 
 
+def generate_dns_incremental(cfg, domain, opts):
+    """
+    Rebuilds and validates only the zones in the dns journal (domain's
+    forward zones and every dirty reverse zone, or every dirty zone
+    with --all), then clears the journal rows it rolled out
+    """
+    tmpdir = cfg.dns_tmpdir
+    if opts.all:
+        domain = None
+    forward, reverse, rows = dirty_zones(cfg, mothership.dns_journal.pending(cfg), domain)
+    if not rows:
+        print "No DNS changes in the journal, nothing to do (use --full to rebuild everything)"
+        return
+    zones = []
+    jobs = [('forward', fqn) for fqn in sorted(forward)]
+    if reverse:
+        if reverse == mothership.dns_journal.ALL:
+            reverse = None
+        jobs.append(('reverse', reverse))
+    for (kind, arg), result in zip(jobs, run_zone_jobs(cfg, opts, jobs)):
+        for zone in result or []:
+            if kind == 'reverse' or os.path.basename(zone) in forward[arg]:
+                zones.append(zone)
+    validate_zone_files(cfg, tmpdir, zones)
+    mothership.dns_journal.clear(cfg, rows)
+    print "%d changed zones validated. Please restart named so the changes can take effect." % len(zones)
+    if opts.all:
+        print "zones.conf was not checked, use --full if zones were added or removed"
+
+
+def run_zone_job(cfg, opts, job):
+    """
+    Generates one set of zones: ('forward', fqn) for the forward zones
+    of fqn, ('reverse', names) for the reverse zones (all of them if
+    names is None). Returns what the generator returned
+    """
+    kind, arg = job
+    if kind == 'forward':
+        return generate_dns_forward(cfg, arg, opts)
+    return generate_dns_reverse(cfg, opts, only=arg)
+
+
+# cfg and opts of a zone worker process, see run_zone_jobs()
+_worker = {}
+
+def _init_zone_worker(cfg, opts):
+    # leave ^C to the parent, and get our own db session
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    cfg.forget_connections()
+    _worker['cfg'] = cfg
+    _worker['opts'] = opts
+
+def _run_zone_worker(job):
+    return run_zone_job(_worker['cfg'], _worker['opts'], job)
+
+
+def run_zone_jobs(cfg, opts, jobs):
+    """
+    Runs zone jobs (see run_zone_job) and returns their results in
+    order. With opts.jobs > 1 and an output directory, the jobs are
+    spread over that many worker processes, each with its own db
+    session. Zones printed to stdout are always generated in order
+    """
+    workers = min(int(getattr(opts, 'jobs', None) or 1), len(jobs))
+    if workers <= 1 or not opts.outdir:
+        return [run_zone_job(cfg, opts, job) for job in jobs]
+    import multiprocessing
+    pool = multiprocessing.Pool(workers, _init_zone_worker, (cfg, opts))
+    try:
+        # waiting with a timeout keeps the parent interruptible
+        results = pool.map_async(_run_zone_worker, jobs, 1).get(86400)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+
+def check_zone(cfg, zone, path):
+    """
+    Runs named-checkzone on the zone file. Returns (ok, output), ok
+    is None if named-checkzone isn't installed
+    """
+    if not os.path.exists(cfg.dns_checkzone):
+        return None, '%s not found, zone not checked' % cfg.dns_checkzone
+    proc = subprocess.Popen([cfg.dns_checkzone, '-q', zone, path],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    if proc.returncode != 0 and not output:
+        # -q only prints errors, get them
+        proc = subprocess.Popen([cfg.dns_checkzone, zone, path],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+    return proc.returncode == 0, output.strip()
+
+
+def inspect_zone(cfg, prefix, tempzone):
+    """
+    Checks a generated zone and compares it to the live one, without
+    asking or touching anything. Returns a dict of the results
+    """
+    livezone = re.sub('^'+prefix, '', tempzone)
+    result = {'temp': tempzone, 'live': livezone}
+    start = time.time()
+    result['ok'], result['check'] = check_zone(cfg, os.path.basename(tempzone), tempzone)
+    result['check_time'] = time.time() - start
+    start = time.time()
+    result['changes'], result['digest'] = zone_changes(cfg, livezone, tempzone)
+    result['compare_time'] = time.time() - start
+    return result
+
+
+def inspect_zones(cfg, prefix, tmpzones):
+    """
+    inspect_zone() on every zone, cfg.dns_check_workers at a time
+    (fewer if there are fewer zones). Returns (results in the order of
+    tmpzones, the number of workers used)
+    """
+    results = [None] * len(tmpzones)
+    pending = Queue.Queue()
+    for n, zone in enumerate(tmpzones):
+        pending.put((n, zone))
+    def work():
+        while True:
+            try:
+                n, zone = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[n] = inspect_zone(cfg, prefix, zone)
+            except Exception, e:
+                results[n] = {'temp': zone, 'live': re.sub('^'+prefix, '', zone),
+                    'ok': False, 'check': 'inspection failed: %s' % e,
+                    'changes': [], 'digest': None,
+                    'check_time': 0, 'compare_time': 0}
+    threads = []
+    workers = max(1, min(cfg.dns_check_workers, len(tmpzones)))
+    for i in range(workers):
+        t = threading.Thread(target=work)
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    return results, workers
+
+
 def validate_zone_files(cfg, prefix, tmpzones):
-    to_reload = False
-    for tempzone in tmpzones:
-        livezone = re.sub('^'+prefix, '', tempzone)
-        compare_files(cfg, livezone, tempzone)
+    """
+    Checks and compares every generated zone in parallel, reports on
+    all of them, and only then asks about rolling out the changed
+    ones. Nothing is rolled out if any zone fails its check
+    """
+    start = time.time()
+    results, workers = inspect_zones(cfg, prefix, tmpzones)
+    inspected = time.time()
+    failed = [r for r in results if r['ok'] is False]
+    unchecked = [r for r in results if r['ok'] is None]
+    changed = [r for r in results if r['changes']]
+    print '-'*60
+    print 'Zone validation: %d zones, %d changed, %d unchanged, %d failed checks' % (
+        len(results), len(changed), len(results) - len(changed), len(failed))
+    if unchecked:
+        print 'WARNING: %s' % unchecked[0]['check']
+    for r in failed:
+        print 'FAILED %s:\n%s' % (os.path.basename(r['temp']), r['check'])
+    print '-'*60
+    if failed:
+        raise DNSError("%d zone(s) failed validation, nothing was rolled out" % len(failed))
+    for r in changed:
+        print 'Changes to %s:' % r['live']
+        print '-'*60
+        for d in r['changes']:
+            print d
+        print '-'*60
+        if confirm_change('dns', os.path.basename(r['live'])):
+            rollout_changes(r['live'], r['temp'])
+            save_digest(r['live'], r['digest'])
+    print 'Timing: checks %.2fs, compares %.2fs (summed over %d workers), ' \
+        'inspection %.2fs, review and rollout %.2fs' % (
+        sum([r['check_time'] for r in results]),
+        sum([r['compare_time'] for r in results]),
+        workers, inspected - start, time.time() - inspected)
 
 
 def validate_zone_config(cfg, prefix, tmpzones):
@@ -348,9 +639,66 @@ def rollout_changes(oldfile, newfile):
     shutil.copy(newfile, oldfile)
 
 
-def compare_files(cfg, oldfile, newfile):
-    reload = False
-    print 'Comparing %s %s' % (oldfile, newfile)
+def zone_digest(path):
+    """
+    Digest of a zone's content as compare_files() sees it: whitespace
+    runs squeezed, blank lines, comment lines and the Serial ignored,
+    and line order ignored (it is the sum of the lines' md5s, so
+    repeated lines still count). Read a line at a time
+    """
+    total = 0
+    for line in open(path):
+        line = re.sub('\s+', ' ', line)
+        if re.match('\s*(;|$)', line) or 'Serial' in line:
+            continue
+        total += long(hashlib.md5(line).hexdigest(), 16)
+    return '%032x' % (total % (1 << 128))
+
+
+def stored_digest(path):
+    """
+    The digest saved next to path by save_digest(), if path hasn't
+    changed since (same mtime and size), else None
+    """
+    try:
+        digest, mtime, size = open(path + '.digest').read().split()
+        st = os.stat(path)
+    except (IOError, OSError, ValueError):
+        return None
+    if (int(mtime), int(size)) != (int(st.st_mtime), st.st_size):
+        return None
+    return digest
+
+
+def save_digest(path, digest):
+    """
+    Save path's digest in path.digest, along with its mtime and size
+    """
+    st = os.stat(path)
+    f = open(path + '.digest', 'w')
+    f.write('%s %d %d\n' % (digest, int(st.st_mtime), st.st_size))
+    f.close()
+
+
+def zone_changes(cfg, oldfile, newfile):
+    """
+    The differences between two zones that matter (not whitespace,
+    comments or the Serial), as difflib lines, and newfile's digest.
+    Zones keep their digest next to them, so an unchanged zone is
+    skipped without reading it, let alone diffing it
+    """
+    live = not (cfg.zonecfg == oldfile)
+    newdigest = zone_digest(newfile)
+    olddigest = None
+    if os.path.exists(oldfile):
+        if live:
+            olddigest = stored_digest(oldfile)
+        if olddigest is None:
+            olddigest = zone_digest(oldfile)
+            if live and olddigest == newdigest:
+                save_digest(oldfile, olddigest)
+    if olddigest == newdigest:
+        return [], newdigest
     # Ignore extra spaces for comparison
     olddata = []
     if os.path.exists(oldfile):
@@ -359,27 +707,34 @@ def compare_files(cfg, oldfile, newfile):
     newdata = sorted([ re.sub('\s+',' ',x)
         for x in open(newfile).readlines() ])
     diff = difflib.Differ().compare(olddata, newdata)
-    changes = False
+    changes = []
     for d in diff:
         # exclude comments, blank/common lines, Serial
         if re.match('[-+]\s+(;|$)', d) \
             or not re.match('[-+]', d) \
             or 'Serial' in d:
             continue
-        if not changes:
-            print '-'*60
-        changes = True
-        print d
+        changes.append(d)
+    return changes, newdigest
+
+
+def compare_files(cfg, oldfile, newfile):
+    reload = False
+    print 'Comparing %s %s' % (oldfile, newfile)
+    changes, newdigest = zone_changes(cfg, oldfile, newfile)
     if not changes:
         # shhhh.
         #print 'Skipping %s, no changes discovered' % oldfile
         return reload
-    else:
-        print '-'*60
-    if changes and not (cfg.zonecfg == oldfile):
+    print '-'*60
+    for d in changes:
+        print d
+    print '-'*60
+    if not (cfg.zonecfg == oldfile):
         if confirm_change('dns', os.path.basename(oldfile)):
             rollout_changes(oldfile, newfile)
-    return changes
+            save_digest(oldfile, newdigest)
+    return True
 
 
 def generate_dns_forward(cfg, domain, opts):
@@ -389,61 +744,42 @@ def generate_dns_forward(cfg, domain, opts):
     Creates the drac forward zonefile (if applicable)
     """
     zones = []
-    zone = None
     fqn = mothership.validate.v_get_fqn(cfg, domain)
     realm, site_id, domain = mothership.validate.v_split_fqn(cfg, fqn)
-    forward = generate_forward_header(cfg, True, fqn, realm, site_id)
-    # generate the main fqn
-    forward += generate_dns_arecords(cfg, realm, site_id)
-    forward += generate_dns_addendum(cfg, realm, site_id)
-    # if we're using drac, generate drac.fqn
+    # each zone is a header followed by record generators, which are
+    # only run as the zone is written out
+    forwards = [
+        # the main fqn
+        (fqn, [generate_forward_header(cfg, True, fqn, realm, site_id),
+               iter_dns_arecords(cfg, realm, site_id, cfg.primary_interface),
+               iter_dns_addendum(cfg, realm, site_id)]),
+        # mgmt.fqn
+        ('mgmt.'+fqn, [generate_forward_header(cfg, True, 'mgmt.'+fqn, realm, site_id),
+                       iter_dns_arecords(cfg, realm, site_id, cfg.mgmt_vlan_interface)]),
+    ]
+    # if we're using drac, drac.fqn
     if cfg.drac:
-        dracforward = generate_forward_header(cfg, True, 'drac.'+fqn, realm, site_id)
-        dracforward += generate_dns_arecords(cfg, realm, site_id, drac=True)
-    # generate mgmt.fqn
-    mgmtforward = generate_forward_header(cfg, True, 'mgmt.'+fqn, realm, site_id)
-    mgmtforward += generate_dns_arecords(cfg, realm, site_id, mgmt=True)
-    if opts.outdir:
-        # write out the main zone
-        zone = '%s/%s' % (opts.outdir, fqn)
-        print 'Writing DNS forward zone for %s to %s' % (fqn, zone)
-        zones.append(zone)
-        f = open(zone, 'w')
-        f.write(forward)
-        f.close()
-        # write out the mgmt zone
-        zone = '%s/%s' % (opts.outdir, 'mgmt.'+fqn)
-        print 'Writing DNS forward zone for %s to %s' % ('mgmt.'+fqn, zone)
-        zones.append(zone)
-        f = open(zone, 'w')
-        f.write(mgmtforward)
-        f.close()
-        # write out the drac zone
-        if cfg.drac:
-            zone = '%s/%s' % (opts.outdir, 'drac.'+fqn)
-            print 'Writing DNS forward zone for %s to %s' % ('drac.'+fqn, zone)
+        forwards.append(('drac.'+fqn,
+            [generate_forward_header(cfg, True, 'drac.'+fqn, realm, site_id),
+             iter_dns_arecords(cfg, realm, site_id, 'drac')]))
+    for name, parts in forwards:
+        if opts.outdir:
+            zone = '%s/%s' % (opts.outdir, name)
+            print 'Writing DNS forward zone for %s to %s' % (name, zone)
+            write_zone(zone, parts)
             zones.append(zone)
-            f = open(zone, 'w')
-            f.write(dracforward)
-            f.close()
-        
-    else:
-        print '\n' + '-'*60 + '\nDNS forward zone for %s:\n' % fqn + '-'*60
-        print forward
-        print '\n' + '-'*60 + '\nDNS forward zone for %s:\n' % 'mgmt.'+fqn + '-'*60
-        print mgmtforward
-        if cfg.drac:
-            print '\n' + '-'*60 + '\nDNS forward zone for %s:\n' % 'drac.'+fqn + '-'*60
-            print dracforward
+        else:
+            print_zone('forward', name, parts)
     if zones:
         return zones
     else:
         return None
 
 
-def generate_dns_reverse(cfg, opts):
+def generate_dns_reverse(cfg, opts, only=None):
     """
     Creates the reverse zonefiles for the specified domain
+    If only is given, just the zones named in it are created
     """
     dracnetblocks = ''
     zones = []
@@ -453,55 +789,28 @@ def generate_dns_reverse(cfg, opts):
         dracnetblocks = mothership.network_mapper.remap(cfg, 'cidr', nic='drac')
     if not netblocks or not mgmtnetblocks or (cfg.drac and not dracnetblocks):
         return False
-    # do this whole mess once for the primary networks 
-    for cidr in netblocks:
-        net, rev = generate_regular_arpa(cfg, cidr)
-        net = '%s.in-addr.arpa' % '.'.join(reversed(net.split('.')))
-        reverse = generate_reverse_header(cfg)
-        reverse += rev
-        if opts.outdir:
-            zone = '%s/%s' % (opts.outdir, net)
-            print 'Writing DNS reverse zone for %s to %s' % (net, zone)
-            f = open(zone, 'w')
-            f.write(reverse)
-            f.close()
-            zones.append(zone)
-        else:
-            print '\n' + '-'*60 + '\nDNS reverse zone for %s:\n' % net  + '-'*60
-            print reverse
-    # redo the whole mess again for the mgmt nets
-    for cidr in mgmtnetblocks:
-        net, rev = generate_mgmt_arpa(cfg, cidr)
-        net = '%s.in-addr.arpa' % '.'.join(reversed(net.split('.')))
-        reverse = generate_reverse_header(cfg)
-        reverse += rev
-        if opts.outdir:
-            zone = '%s/%s' % (opts.outdir, net)
-            print 'Writing DNS reverse zone for %s to %s' % (net, zone)
-            f = open(zone, 'w')
-            f.write(reverse)
-            f.close()
-            zones.append(zone)
-        else:
-            print '\n' + '-'*60 + '\nDNS reverse zone for %s:\n' % net  + '-'*60
-            print reverse
-    # redo the whole mess again for the dracs
+    # the primary networks, then the mgmt nets, then the dracs. every
+    # server interface is read once and sorted into its zones up front
+    kinds = [(cfg.primary_interface, netblocks, ''),
+             (cfg.mgmt_vlan_interface, mgmtnetblocks, 'mgmt.')]
     if dracnetblocks:
-        for cidr in dracnetblocks:
-            net, rev = generate_drac_arpa(cfg, cidr)
-            net = '%s.in-addr.arpa' % '.'.join(reversed(net.split('.')))
-            reverse = generate_reverse_header(cfg)
-            reverse += rev
+        kinds.append(('drac', dracnetblocks, 'drac.'))
+    buckets = bucket_arpa_rows(cfg, [(interface, cidrs) for interface, cidrs, label in kinds])
+    for (interface, cidrs, label), rows in zip(kinds, buckets):
+        for cidr, cidr_rows in zip(cidrs, rows):
+            net = mothership.network_mapper.get_reverse_zone(cidr)
+            if only is not None and net not in only:
+                continue
+            num = mothership.network_mapper.get_arpa_network(cidr)[1]
+            parts = [generate_reverse_header(cfg),
+                     iter_arpa_records(cfg, cidr_rows, num, label)]
             if opts.outdir:
                 zone = '%s/%s' % (opts.outdir, net)
                 print 'Writing DNS reverse zone for %s to %s' % (net, zone)
-                f = open(zone, 'w')
-                f.write(reverse)
-                f.close()
+                write_zone(zone, parts)
                 zones.append(zone)
             else:
-                print '\n' + '-'*60 + '\nDNS reverse zone for %s:\n' % net  + '-'*60
-                print reverse
+                print_zone('reverse', net, parts)
     if zones:
         return zones
     else:
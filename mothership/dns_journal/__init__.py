@@ -0,0 +1,151 @@
+# Copyright 2011 Gilt Groupe, INC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+the dns change journal
+
+every flush that touches the servers, network or dns_addendum tables
+records which zones the change lands in, in the dns_journal table and
+in the same transaction. "ship generate_dns --system" then only
+rebuilds and validates the zones in the journal, and clears them once
+they are rolled out.
+
+journal rows are either
+    forward: (realm, site_id, interface, None), interface None meaning
+             every forward zone of realm.site_id
+    reverse: (None, None, interface, <in-addr.arpa zone>), zone '*'
+             meaning every reverse zone
+"""
+
+import mothership.network_mapper
+from mothership.mothership_models import *
+
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.orm.interfaces import SessionExtension
+
+# zone meaning "all of them"
+ALL = '*'
+
+
+def _versions(obj, keys, deleted=False):
+    """
+        The values of keys on obj as it is now and as it was before
+        this flush (the same dict twice if nothing changed). A deleted
+        object only has its old version
+    """
+    new = {}
+    old = {}
+    for key in keys:
+        added, unchanged, removed = get_history(obj, key)
+        new[key] = getattr(obj, key)
+        if removed:
+            old[key] = removed[0]
+        else:
+            old[key] = new[key]
+    if deleted:
+        return [old]
+    return [new, old]
+
+
+def reverse_zones(cfg, interface, ip):
+    """
+        The reverse zones of the interface's netblocks that contain ip
+    """
+    if not ip:
+        return []
+    cidrs = mothership.network_mapper.remap(cfg, 'cidr', nic=interface) or []
+    return [mothership.network_mapper.get_reverse_zone(c) for c in cidrs
+            if mothership.network_mapper.within(ip, c)]
+
+
+def network_entries(cfg, row):
+    """
+        Journal entries for a network row (a dict of its columns)
+    """
+    if not row['server_id'] or row['interface'] not in \
+        [cfg.primary_interface, cfg.mgmt_vlan_interface, 'drac']:
+        return set()
+    entries = set([(row['realm'], row['site_id'], row['interface'], None)])
+    for zone in reverse_zones(cfg, row['interface'], row['ip']):
+        entries.add((None, None, row['interface'], zone))
+    return entries
+
+
+network_keys = ['ip', 'interface', 'realm', 'site_id', 'server_id']
+
+def changed_entries(cfg, session, obj, deleted=False):
+    """
+        Journal entries for a new, changed or deleted object
+    """
+    entries = set()
+    if isinstance(obj, Network):
+        for row in _versions(obj, network_keys, deleted):
+            entries |= network_entries(cfg, row)
+    elif isinstance(obj, DnsAddendum):
+        for row in _versions(obj, ['realm', 'site_id'], deleted):
+            entries.add((row['realm'], row['site_id'], cfg.primary_interface, None))
+    elif isinstance(obj, Server) and obj.id is not None:
+        versions = _versions(obj, ['hostname', 'realm', 'site_id'], deleted)
+        if not deleted and versions[0] == versions[1]:
+            return entries
+        # the server's name is in the records of all its interfaces
+        rows = session.query(Network).filter(Network.server_id==obj.id).all()
+        for n in rows:
+            entries |= network_entries(cfg, dict([(k, getattr(n, k)) for k in network_keys]))
+        for row in versions:
+            if rows:
+                for n in rows:
+                    entries.add((row['realm'], row['site_id'], n.interface, None))
+            else:
+                # its interfaces are already gone, so we can't tell
+                # which zones it was in
+                entries.add((row['realm'], row['site_id'], None, None))
+                entries.add((None, None, None, ALL))
+    return entries
+
+
+class JournalExtension(SessionExtension):
+    """
+        Adds dns_journal rows for the zones each flush touches
+    """
+    def __init__(self, cfg):
+        self.cfg = cfg
+
+    def before_flush(self, session, flush_context, instances):
+        entries = set()
+        for obj in list(session.new) + list(session.dirty):
+            if session.is_modified(obj) or obj in session.new:
+                entries |= changed_entries(self.cfg, session, obj)
+        for obj in list(session.deleted):
+            entries |= changed_entries(self.cfg, session, obj, deleted=True)
+        for realm, site_id, interface, zone in entries:
+            session.add(DnsJournal(realm, site_id, interface, zone))
+
+
+def pending(cfg):
+    """
+        The journal rows not yet cleared, oldest first
+    """
+    return cfg.dbsess.query(DnsJournal).order_by(DnsJournal.id).all()
+
+
+def clear(cfg, rows):
+    """
+        Drop journal rows once the zones they name have been rolled out
+    """
+    ids = [j.id for j in rows]
+    for i in range(0, len(ids), 1000):
+        cfg.dbsess.query(DnsJournal).\
+            filter(DnsJournal.id.in_(ids[i:i+1000])).\
+            delete(synchronize_session=False)
+    cfg.dbsess.commit()
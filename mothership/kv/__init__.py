@@ -15,9 +15,16 @@
     mothership.kv
 
     Package for interacting with the KV store in mothership
+
+    select() and collect() are answered from cfg.kvcache, which loads
+    the KVs of a scope (global, site, realm or host) the first time
+    one is asked for. add(), upsert() and delete() go to the database
+    and drop the scope they wrote to from the cache
 """
 
-from sqlalchemy import or_, desc, MetaData
+import time
+
+from sqlalchemy import or_, and_, desc, bindparam, MetaData
 
 import mothership
 from mothership.mothership_models import *
@@ -25,6 +32,136 @@ from mothership.mothership_models import *
 class KVError(Exception):
     pass
 
+class KVCache(object):
+    """
+        The KV rows of each (hostname, realm, site_id) scope looked up
+        so far, as detached KV objects. Everything is dropped ttl
+        seconds after the first scope was loaded, so other processes'
+        writes are picked up; a ttl of 0 means every lookup reloads
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.clear()
+
+    def clear(self):
+        self.scopes = {}
+        self.everything = False
+        self.loaded_at = None
+
+    def invalidate(self, fqdn):
+        """
+            Forget the scope of fqdn, after a write to it
+        """
+        self.scopes.pop(tuple(mothership.split_fqdn(fqdn)), None)
+        self.everything = False
+
+    def _expire(self):
+        if self.loaded_at is not None and time.time() - self.loaded_at >= self.ttl:
+            self.clear()
+
+    def _load(self, cfg, scopes=None):
+        """
+            Read the scopes not cached yet in one query, or the whole
+            table if scopes is None
+        """
+        if scopes is not None:
+            scopes = [s for s in scopes if s not in self.scopes]
+            if not scopes:
+                return
+        query = cfg.dbsess.query(KV.id, KV.key, KV.value, KV.hostname, KV.realm, KV.site_id)
+        if scopes is not None:
+            query = query.filter(or_(*[and_(KV.hostname==h, KV.realm==r, KV.site_id==s)
+                for (h, r, s) in scopes]))
+        else:
+            self.scopes = {}
+            self.everything = True
+        for s in scopes or []:
+            self.scopes[s] = []
+        if self.loaded_at is None:
+            self.loaded_at = time.time()
+        for (id, key, value, hostname, realm, site_id) in query.order_by(KV.id):
+            kv = KV(key, value, hostname, realm, site_id)
+            kv.id = id
+            self.scopes.setdefault((hostname, realm, site_id), []).append(kv)
+
+    def load_site(self, cfg, realm, site_id, hostnames):
+        """
+            Read, in one query, every KV that applies to a host of
+            realm.site_id: the global, site, realm and realm.site KVs,
+            and those of hostnames. search() then answers for any of
+            hostnames without going to the database
+        """
+        self._expire()
+        if self.everything:
+            return
+        scopes = []
+        for h in _unique([None] + list(hostnames)):
+            for r in [None, realm]:
+                for s in [None, site_id]:
+                    scopes.append((h, r, s))
+        for s in scopes:
+            self.scopes[s] = []
+        if self.loaded_at is None:
+            self.loaded_at = time.time()
+        wanted = set(scopes)
+        query = cfg.dbsess.query(KV.id, KV.key, KV.value, KV.hostname, KV.realm, KV.site_id).\
+            filter(or_(KV.realm==None, KV.realm==realm)).\
+            filter(or_(KV.site_id==None, KV.site_id==site_id)).\
+            order_by(KV.id)
+        for (id, key, value, h, r, s) in query:
+            if (h, r, s) in wanted:
+                kv = KV(key, value, h, r, s)
+                kv.id = id
+                self.scopes[(h, r, s)].append(kv)
+
+    def scope(self, cfg, fqdn):
+        """
+            The KVs set on exactly the scope of fqdn
+        """
+        self._expire()
+        s = tuple(mothership.split_fqdn(fqdn))
+        if not self.everything:
+            self._load(cfg, [s])
+        return self.scopes.get(s, [])
+
+    def search(self, cfg, fqdn):
+        """
+            The KVs that apply to fqdn, least specific scope first (the
+            order of collect()'s query): global, then site, realm, and
+            realm.site, then the host's. With fqdn None, all KVs
+        """
+        self._expire()
+        if fqdn is None:
+            if not self.everything:
+                self._load(cfg)
+            kvs = []
+            for rows in self.scopes.values():
+                kvs.extend(rows)
+            kvs.sort(key=lambda kv: kv.id)
+            return kvs
+        hostname, realm, site_id = mothership.split_fqdn(fqdn)
+        scopes = []
+        for h in _unique([None, hostname]):
+            for r in _unique([None, realm]):
+                for s in _unique([None, site_id]):
+                    scopes.append((h, r, s))
+        if not self.everything:
+            self._load(cfg, scopes)
+        kvs = []
+        for s in scopes:
+            kvs.extend(self.scopes.get(s, []))
+        return kvs
+
+def _unique(values):
+    """
+        values without repeats, in order
+    """
+    seen = []
+    for v in values:
+        if v not in seen:
+            seen.append(v)
+    return seen
+
 def new(fqdn, key, value):
     """
     Constructor that takes a host.realm.site style fqdn.
@@ -37,6 +174,15 @@ def select(cfg, fqdn, key, value=None):
     """
     Returns a specific KV object.
     """
+    for kv in cfg.kvcache.scope(cfg, fqdn):
+        if kv.key == key and (not value or kv.value == value):
+            return kv
+    return None
+
+def _select(cfg, fqdn, key, value=None):
+    """
+    select() from the database, for changing or deleting the KV
+    """
     hostname, realm, site_id = mothership.split_fqdn(fqdn)
     results = cfg.dbsess.query(KV).\
             filter(KV.hostname==hostname).\
@@ -48,26 +194,27 @@ def select(cfg, fqdn, key, value=None):
     kv = results.first()
     return kv
 
-def collect(cfg, fqdn, key=None, value=None):
+def get_many(cfg, fqdn, keys, required=True):
     """
-    Returns a list of all matches.
+    Returns a dict of the values of keys set on exactly fqdn (the way
+    select() finds them), all read with a single query. A missing key
+    raises KVError if required, otherwise its value is None
     """
-    results = cfg.dbsess.query(KV)
+    values = dict([(key, None) for key in keys])
+    for kv in cfg.kvcache.scope(cfg, fqdn):
+        if kv.key in values and values[kv.key] is None:
+            values[kv.key] = kv.value
+    missing = [key for key in keys if values[key] is None]
+    if required and missing:
+        raise KVError('No %s KV for "%s"' % (', '.join(missing), fqdn or 'global'))
+    return values
 
-    if fqdn != None:
-        hostname, realm, site_id = mothership.split_fqdn(fqdn)
-        results = results.\
-            filter(or_(KV.site_id==site_id, KV.site_id==None)).\
-            filter(or_(KV.realm==realm, KV.realm==None)).\
-            filter(or_(KV.hostname==hostname, KV.hostname==None)).\
-            order_by(desc(KV.hostname), desc(KV.realm), desc(KV.site_id))
-    if key:
-        results = results.filter(KV.key==key)
-    if value:
-        results = results.filter(KV.value==value)
-
-    kvs = results.all()
-    return kvs
+def collect(cfg, fqdn, key=None, value=None):
+    """
+    Returns a list of all matches, the most specific last.
+    """
+    return [kv for kv in cfg.kvcache.search(cfg, fqdn)
+            if (not key or kv.key == key) and (not value or kv.value == value)]
 
 def add(cfg, fqdn, key, value):
     """
@@ -97,7 +244,7 @@ def add(cfg, fqdn, key, value):
             raise KVError('Trying to apply a tag to a nonexistent host. Abort!')
 
     # Check for duplicate key=value.
-    kv = select(cfg, fqdn, key, value)
+    kv = _select(cfg, fqdn, key, value)
     if kv:
         print "that key=value pair exists already!"
         ans = raw_input("Do you want to update it? (y/n): ")
@@ -116,17 +263,19 @@ def add(cfg, fqdn, key, value):
             kv = new(fqdn, key, value)
             cfg.dbsess.add(kv)
             cfg.dbsess.commit()
+            cfg.kvcache.invalidate(fqdn)
             return kv
     kv = new(fqdn, key, value)
     cfg.dbsess.add(kv)
     cfg.dbsess.commit()
+    cfg.kvcache.invalidate(fqdn)
     return kv
 
 def upsert(cfg, fqdn, key, value):
     """
     Insert a new value or update existing.
     """
-    kv = select(cfg, fqdn, key)
+    kv = _select(cfg, fqdn, key)
     if not kv:
         print "key=value not found, adding"
         kv = new(fqdn, key, value)
@@ -134,15 +283,146 @@ def upsert(cfg, fqdn, key, value):
     kv.value = value
     cfg.dbsess.add(kv)
     cfg.dbsess.commit()
+    cfg.kvcache.invalidate(fqdn)
     return kv
 
 def delete(cfg, fqdn, key, value):
     """
     Delete a row matching both key and value.
     """
-    kv = select(cfg, fqdn, key, value=value)
+    kv = _select(cfg, fqdn, key, value=value)
     if kv:
         cfg.dbsess.delete(kv)
         cfg.dbsess.commit()
+        cfg.kvcache.invalidate(fqdn)
     else:
         print "key=value not found, exiting."
+
+def scope_name(hostname, realm, site_id):
+    """
+    The name ship kv takes for a scope: host.realm.site, realm.site,
+    site, or . for global
+    """
+    return '.'.join([p for p in [hostname, realm, site_id] if p]) or '.'
+
+def export(cfg, fqdn=None):
+    """
+    All KVs (or those that apply to fqdn) as {scope name: {key: value}},
+    the format import_plan() reads. A key with several values in a
+    scope gets the list of them
+    """
+    data = {}
+    for kv in collect(cfg, fqdn):
+        keys = data.setdefault(scope_name(kv.hostname, kv.realm, kv.site_id), {})
+        if kv.key not in keys:
+            keys[kv.key] = kv.value
+        elif isinstance(keys[kv.key], list):
+            keys[kv.key].append(kv.value)
+        else:
+            keys[kv.key] = [keys[kv.key], kv.value]
+    return data
+
+def import_plan(cfg, data):
+    """
+    Works out what importing data ({scope name: {key: value}}, see
+    export()) changes, reading the existing KVs of all its scopes in
+    one query. A single value replaces the key's value (like upsert),
+    a list of values adds the ones missing (like add). A single value
+    for a key that has several in its scope is refused, since it
+    couldn't replace them all. Returns
+    (inserts, updates, unchanged): lists of (scope, key, value),
+    (id, scope, key, old value, new value) and (scope, key, value)
+    """
+    wanted = []
+    for name, keys in data.items():
+        if name == '.':
+            name = ''
+        scope = tuple(mothership.split_fqdn(str(name)))
+        if not isinstance(keys, dict):
+            raise KVError('%s: expected a mapping of key: value' % (name or '.'))
+        for key, values in keys.items():
+            if values is None or values == []:
+                raise KVError('%s: no value for %s' % (name or '.', key))
+            wanted.append((scope, str(key), values))
+    check_import(cfg, wanted)
+
+    # everything already set on the scopes being imported to
+    existing = {}
+    scopes = _unique([scope for (scope, key, values) in wanted])
+    for i in range(0, len(scopes), 500):
+        query = cfg.dbsess.query(KV.id, KV.key, KV.value, KV.hostname, KV.realm, KV.site_id).\
+            filter(or_(*[and_(KV.hostname==h, KV.realm==r, KV.site_id==s)
+                for (h, r, s) in scopes[i:i+500]])).\
+            order_by(KV.id)
+        for (id, key, value, hostname, realm, site_id) in query:
+            existing.setdefault(((hostname, realm, site_id), key), []).append((id, value))
+
+    inserts = []
+    updates = []
+    unchanged = []
+    for (scope, key, values) in wanted:
+        rows = existing.get((scope, key), [])
+        if isinstance(values, list):
+            have = [value for (id, value) in rows]
+            for value in _unique([str(v) for v in values]):
+                if value in have:
+                    unchanged.append((scope, key, value))
+                else:
+                    inserts.append((scope, key, value))
+        else:
+            value = str(values)
+            if len(rows) > 1:
+                raise KVError('%s: %s has %d values, import a list of them instead of a single value' % (
+                    scope_name(*scope), key, len(rows)))
+            if not rows:
+                inserts.append((scope, key, value))
+            elif rows[0][1] == value:
+                unchanged.append((scope, key, value))
+            else:
+                updates.append((rows[0][0], scope, key, rows[0][1], value))
+    return inserts, updates, unchanged
+
+def check_import(cfg, wanted):
+    """
+    The checks add() makes, for a whole import at once: tags must
+    exist, and so must the hosts KVs are set on
+    """
+    tags = _unique([str(v) for (scope, key, values) in wanted if key == 'tag'
+        for v in (isinstance(values, list) and values or [values])])
+    found = []
+    for i in range(0, len(tags), 1000):
+        found.extend([t for (t,) in cfg.dbsess.query(Tag.name).filter(Tag.name.in_(tags[i:i+1000]))])
+    missing = [t for t in tags if t not in found]
+    if missing:
+        raise KVError('nonexistent tag(s): %s. Try "ship tag --help" for more info' % ', '.join(missing))
+
+    hosts = _unique([scope for (scope, key, values) in wanted if scope[0]])
+    names = _unique([h for (h, r, s) in hosts])
+    found = []
+    for i in range(0, len(names), 1000):
+        found.extend(cfg.dbsess.query(Server.hostname, Server.realm, Server.site_id).\
+            filter(Server.hostname.in_(names[i:i+1000])).all())
+    found = [tuple(row) for row in found]
+    missing = [scope_name(*h) for h in hosts if h not in found]
+    if missing:
+        raise KVError('nonexistent host(s): %s' % ', '.join(missing))
+
+def import_apply(cfg, inserts, updates):
+    """
+    Apply an import_plan(): one executemany for the inserts and one
+    for the updates, committed as a single transaction
+    """
+    import mothership.node_cache
+    table = KV.__table__
+    if inserts:
+        cfg.dbconn.execute(table.insert(), [{'hostname': h, 'realm': r, 'site_id': s,
+            'key': key, 'value': value} for ((h, r, s), key, value) in inserts])
+    if updates:
+        cfg.dbconn.execute(table.update().where(table.c.id==bindparam('kv_id')).\
+            values(value=bindparam('new_value')),
+            [{'kv_id': id, 'new_value': new} for (id, scope, key, old, new) in updates])
+    # these don't go through the session, so its extensions don't see them
+    mothership.node_cache.invalidate(cfg.dbsess, [scope for (scope, key, value) in inserts]
+        + [scope for (id, scope, key, old, new) in updates])
+    cfg.dbsess.commit()
+    cfg.kvcache.clear()
@@ -48,12 +48,8 @@ def get_master(cfg, realm_path):
     fqn = mothership.validate.v_get_fqn(cfg, realm_path)
     realm, site_id, domain = mothership.validate.v_split_fqn(cfg, fqn)
 
-    serv = None
-
-    try:
-        serv = str(mothership.kv.select(cfg, realm_path, key='ldap_master_server')).split('=')[1]
-    except:
-        pass 
+    serv = mothership.kv.get_many(cfg, realm_path, ['ldap_master_server'],
+        required=False)['ldap_master_server']
 
     return serv
 
@@ -74,8 +70,9 @@ def ld_connect(cfg, ldap_master, realm, site_id):
 
     d = cfg.domain.split('.')
 
-    admin_cn = str(mothership.kv.select(cfg, ldap_master, key="ldap_admin_cn")).split('=')[1]
-    admin_pass = str(mothership.kv.select(cfg, ldap_master, key="ldap_admin_pass")).split('=')[1]
+    creds = mothership.kv.get_many(cfg, ldap_master, ['ldap_admin_cn', 'ldap_admin_pass'])
+    admin_cn = creds['ldap_admin_cn']
+    admin_pass = creds['ldap_admin_pass']
     admin_dn = "cn=%s,dc=%s,dc=%s,dc=" % (admin_cn, realm, site_id)
     admin_dn += ',dc='.join(d)
     ld_server_string = "ldap://"+ldap_master
@@ -20,13 +20,30 @@ import subprocess
 
 # Useful handy functions brought in from mothership
 from mothership.kv import collect as kv_collect
-from mothership.kv import select as kv_select
+from mothership.kv import get_many as kv_get_many
 
 # All of the models and sqlalchemy are brought in
 # to simplify referencing
 from mothership.mothership_models import *
 
 
+def get_credentials(cfg):
+    """
+    [description]
+    retrieves the management vlan web control panel user and password, both from the global KV in one lookup
+
+    [parameter info]
+    required:
+        cfg: the config object. useful everywhere
+
+    [return value]
+    returns user, password as a list
+    """
+
+    creds = kv_get_many(cfg, '', ['mgmt_vlan_web_control_user', 'mgmt_vlan_web_control_password'])
+    return [creds['mgmt_vlan_web_control_user'], creds['mgmt_vlan_web_control_password']]
+
+
 def enable(cfg, host, realm, site_id):
     """
     [description]
@@ -44,8 +61,7 @@ def enable(cfg, host, realm, site_id):
     """ 
 
     # get management vlan web control panel credentials
-    discard,user = str(kv_select(cfg, '', key="mgmt_vlan_web_control_user")).split('=')
-    discard,password = str(kv_select(cfg, '', key="mgmt_vlan_web_control_password")).split('=')
+    user, password = get_credentials(cfg)
 
     # get server switch port info
     s, n, h = mothership.snh(cfg, host, realm, site_id)
@@ -88,8 +104,7 @@ def disable(cfg, host, realm, site_id):
     """ 
 
     # get management vlan web control panel credentials
-    discard,user = str(kv_select(cfg, '', key="mgmt_vlan_web_control_user")).split('=')
-    discard,password = str(kv_select(cfg, '', key="mgmt_vlan_web_control_password")).split('=')
+    user, password = get_credentials(cfg)
 
     # get server switch port info
     s, n, h = mothership.snh(cfg, host, realm, site_id)
@@ -133,8 +148,7 @@ def status(cfg, host, realm, site_id):
     """ 
 
     # get management vlan web control panel credentials
-    discard,user = str(kv_select(cfg, '', key="mgmt_vlan_web_control_user")).split('=')
-    discard,password = str(kv_select(cfg, '', key="mgmt_vlan_web_control_password")).split('=')
+    user, password = get_credentials(cfg)
 
     # gather server info
     s, n, h = mothership.snh(cfg, host, realm, site_id)
@@ -164,6 +164,24 @@ class DnsAddendum(Base):
     def __repr__(self):
        return "<DnsAddendum('%s','%s', '%s', '%s')>" % (self.host, self.record_type, self.site_id, self.realm)
 
+class DnsJournal(Base):
+    __tablename__ = 'dns_journal'
+
+    id = Column(Integer, primary_key=True)
+    realm = Column(String)
+    site_id = Column(String)
+    interface = Column(String)
+    zone = Column(String)
+
+    def __init__(self, realm, site_id, interface, zone):
+        self.realm = realm
+        self.site_id = site_id
+        self.interface = interface
+        self.zone = zone
+
+    def __repr__(self):
+        return "<DnsJournal('%s', '%s', '%s', '%s')>" % (self.realm, self.site_id, self.interface, self.zone)
+
 class Network(Base):
     __tablename__ = 'network'
 
@@ -192,6 +210,51 @@ class Network(Base):
     def __repr__(self):
        return "<Network('%s', '%s', '%s', '%s', '%s')>" % (self.ip, self.mac, self.interface, self.site_id, self.realm)
 
+class NodeClassification(Base):
+    __tablename__ = 'node_classification'
+
+    hostname = Column(String, primary_key=True)
+    realm = Column(String, primary_key=True)
+    site_id = Column(String, primary_key=True)
+    cfg_digest = Column(String)
+    yaml = Column(String)
+
+    def __init__(self, hostname, realm, site_id, cfg_digest, yaml):
+        self.hostname = hostname
+        self.realm = realm
+        self.site_id = site_id
+        self.cfg_digest = cfg_digest
+        self.yaml = yaml
+
+    def __repr__(self):
+        return "<NodeClassification('%s', '%s', '%s')>" % (self.hostname, self.realm, self.site_id)
+
+class IdAllocation(Base):
+    __tablename__ = 'id_allocation'
+
+    kind = Column(String, primary_key=True)
+    realm = Column(String, primary_key=True)
+    site_id = Column(String, primary_key=True)
+
+    def __init__(self, kind, realm, site_id):
+        self.kind = kind
+        self.realm = realm
+        self.site_id = site_id
+
+    def __repr__(self):
+        return "<IdAllocation('%s', '%s', '%s')>" % (self.kind, self.realm, self.site_id)
+
+class VlanLock(Base):
+    __tablename__ = 'vlan_lock'
+
+    vlan = Column(Integer, primary_key=True, autoincrement=False)
+
+    def __init__(self, vlan):
+        self.vlan = vlan
+
+    def __repr__(self):
+        return "<VlanLock('%s')>" % self.vlan
+
 class XenPools(Base):
     __tablename__ = 'xen_pools'
 
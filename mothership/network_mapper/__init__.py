@@ -18,29 +18,87 @@
 import re
 import sets
 import types
+import bisect
 import socket
 import struct
 
-
 """
     define custom ip functions below to avoid any licensing issues
+
+    addresses are worked on as 32-bit longs, and only turned back into
+    dotted quads for the caller
 """
 _netmasks = list(((0xffffffffL << x) & 0xffffffffL) for x in range(32,-1,-1))
+# cidr -> (network, broadcast) as longs, see cidr_range()
+_cidr_ranges = {}
+# numpy, once _numpy() has tried to import it: False until then,
+# None if it isn't installed
+_numpy_module = False
+
+def _numpy():
+    """
+        numpy, or None if it isn't installed. Imported on first use so
+        that a plain ship command doesn't load it; bulk classification
+        sweeps the ips with numpy when it is installed, and with a plain
+        python merge when it isn't
+    """
+    global _numpy_module
+    if _numpy_module is False:
+        try:
+            import numpy
+            _numpy_module = numpy
+        except ImportError:
+            _numpy_module = None
+    return _numpy_module
+
+def cidr_range(cidr):
+    """
+        The (network, broadcast) addresses of cidr as longs.
+        Computed once per cidr and remembered, the network map and
+        the dns zones only ever use a handful of them
+    """
+    try:
+        return _cidr_ranges[cidr]
+    except KeyError:
+        pass
+    mask = _netmasks[int(cidr.split('/')[1])]
+    network = ip2long(cidr.split('/')[0]) & mask
+    rng = (network, network | (~mask & 0xffffffffL))
+    _cidr_ranges[cidr] = rng
+    return rng
+
 def get_netmask(cidr):
     # the netmasks list is indexed by cidr
-    return '.'.join(map(str, [ _netmasks[int(cidr.split('/')[1])] % (256**i) / (256**(i-1)) for i in range(4,0,-1) ]))
+    return long2ip(_netmasks[int(cidr.split('/')[1])])
 
 def get_network(cidr):
     # network address is simply long ip bitwise-and against netmask  
-    return long2ip(ip2long(cidr.split('/')[0]) & _netmasks[int(cidr.split('/')[1])])
+    return long2ip(cidr_range(cidr)[0])
 
 def get_broadcast(cidr):
-    # broadcast is network XOR wildcard
-    return '.'.join(map(str, [ int(get_network(cidr).split('.')[i]) ^ int(get_wildcard(cidr).split('.')[i]) for i in range(0,4) ]))
+    # broadcast is network OR wildcard
+    return long2ip(cidr_range(cidr)[1])
 
 def get_wildcard(cidr):
-    # each netmask octet XOR 255 will produce wildcard address
-    return '.'.join(['%d' % (255^x) for x in map(int, get_netmask(cidr).split('.'))])
+    # the netmask with every bit flipped
+    return long2ip(~_netmasks[int(cidr.split('/')[1])] & 0xffffffffL)
+
+def get_arpa_network(cidr):
+    """
+        The network of cidr with its trailing .0 octets stripped, and
+        the number of octets stripped: the reverse zone's network and
+        how many octets of an ip make up a record name in it
+    """
+    net = get_network(cidr)
+    num = 0
+    while re.search('\.0+$', net):
+        net = re.sub('\.0+$', '', net)
+        num += 1
+    return net, num
+
+def get_reverse_zone(cidr):
+    # the in-addr.arpa zone the addresses of cidr go in
+    return '%s.in-addr.arpa' % '.'.join(reversed(get_arpa_network(cidr)[0].split('.')))
 
 def ip2long(ip):
     return struct.unpack("!L", socket.inet_aton(ip))[0]
@@ -51,50 +109,279 @@ def long2ip(ip):
 def within(ip, cidr):
     if ip is None:
         return False
-    #print '%s <= %s <= %s' % (ip2long(get_network(cidr)), ip2long(ip), ip2long(get_broadcast(cidr)))
-    if ip2long(ip) >= ip2long(get_network(cidr)) and ip2long(ip) <= ip2long(get_broadcast(cidr)):
-        return True
-    else:
-        return False
+    ip = ip2long(ip)
+    network, broadcast = cidr_range(cidr)
+    return network <= ip <= broadcast
 
 
-# wtf does this pile of crap do? maybe someone should have put some comments in this thing...
-def remap(cfg, request, **kv):
+class NetworkMap(object):
     """
-       Removed dictlist and migrated it to mothership.yaml
+        cfg.network_map compiled into lookup indexes, so remap() requests
+        don't have to walk every line of the map and redo the cidr string
+        math each time:
+            - a value -> lines index for every key (vlan, nic, name, gw...)
+            - a domain component -> lines index (siteid) and a domain ->
+              lines index (dom)
+            - a sorted interval index of the integer cidr ranges (ip)
+        Requests are narrowed down with the indexes, then the remaining
+        lines are checked (in map order) with the same rules remap()
+        always used, so answers are the same as walking the map
     """
-    netmap = cfg.network_map
-    netblocks = []
-    doms = []
-    if request=='gw' or 'gw' in request:
-        if 'vlan' not in kv.keys() and 'ip' not in kv.keys():
-            print 'Either vlan or ip MUST be specified when requesting gw'
+    def __init__(self, netmap):
+        self.netmap = netmap
+        self.lines = list(netmap)
+        self.all = set(range(len(self.lines)))
+        # key -> lines that have that key
+        self.has = {}
+        # key -> value -> lines, and key -> lines with unhashable values
+        self.values = {}
+        self.unindexed = {}
+        # siteid: domain component -> lines that have it in every domain
+        self.siteids = {}
+        self.siteid_any = set()
+        self.siteid_lazy = set()
+        # dom: domain -> lines listing it
+        self.doms = {}
+        self.dom_lazy = set()
+        # ip: (network, broadcast) as longs per line, None if unparsable
+        self.ranges = []
+        self.cidr_lazy = set()
+        self.masks = {}
+
+        for i, line in enumerate(self.lines):
+            for key, value in line.items():
+                self.has.setdefault(key, set()).add(i)
+                if key == 'dom':
+                    continue
+                try:
+                    self.values.setdefault(key, {}).setdefault(value, set()).add(i)
+                except TypeError:
+                    self.unindexed.setdefault(key, set()).add(i)
+            if 'dom' in line:
+                self._index_dom(i, line['dom'])
+            rng = None
+            if 'cidr' in line:
+                try:
+                    rng = cidr_range(line['cidr'])
+                except Exception:
+                    self.cidr_lazy.add(i)
+            self.ranges.append(rng)
+        self._index_ranges()
+
+    def _index_dom(self, i, dom):
+        """
+            Index one line's dom for siteid and dom requests
+        """
+        # siteid must be a component of every domain on the line
+        try:
+            common = None
+            for hey in dom:
+                parts = set(hey.split('.'))
+                if common is None:
+                    common = parts
+                else:
+                    common = common & parts
+            if common is None:
+                self.siteid_any.add(i)
+            else:
+                for part in common:
+                    self.siteids.setdefault(part, set()).add(i)
+        except (TypeError, AttributeError):
+            self.siteid_lazy.add(i)
+        # dom is a membership test (a substring test if dom is a string)
+        if isinstance(dom, (types.ListType, types.TupleType)):
+            try:
+                for d in dom:
+                    self.doms.setdefault(d, set()).add(i)
+            except TypeError:
+                self.dom_lazy.add(i)
+        else:
+            self.dom_lazy.add(i)
+
+    def _index_ranges(self):
+        """
+            Split the cidr ranges into elementary segments: self.bounds
+            holds the sorted segment starts and self.segments the lines
+            covering each one, so an ip is located with one bisect
+        """
+        bounds = set()
+        for rng in self.ranges:
+            if rng is not None:
+                bounds.add(rng[0])
+                bounds.add(rng[1] + 1)
+        self.bounds = sorted(bounds)
+        self.segments = []
+        for start in self.bounds:
+            covering = set()
+            for i, rng in enumerate(self.ranges):
+                if rng is not None and rng[0] <= start <= rng[1]:
+                    covering.add(i)
+            self.segments.append(covering)
+
+    def lines_within(self, ip):
+        """
+            Lines whose cidr contains ip (a long)
+        """
+        pos = bisect.bisect_right(self.bounds, ip) - 1
+        if pos < 0:
+            return set()
+        return self.segments[pos]
+
+    def _missing(self, key):
+        return self.all - self.has.get(key, set())
+
+    def _narrow(self, k, v):
+        """
+            Lines that can satisfy the request k=v, or None if the
+            indexes can't narrow it down
+        """
+        try:
+            hash(v)
+        except TypeError:
+            return None
+        found = None
+        if k == 'siteid':
+            found = self._missing('dom') | self.siteids.get(v, set()) | \
+                    self.siteid_any | self.siteid_lazy
+        elif k == 'ip':
+            within_lines = set()
+            if v is not None:
+                try:
+                    within_lines = self.lines_within(ip2long(v))
+                except Exception:
+                    return None
+            found = self._missing('cidr') | within_lines | self.cidr_lazy
+        elif k == 'dom':
+            return self._missing('dom') | self.doms.get(v, set()) | self.dom_lazy
+        # everything else (siteid and ip included, should a line
+        # have keys by those names) must equal the line's value
+        if k in self.has:
+            equal = self._missing(k) | self.values.get(k, {}).get(v, set()) | \
+                    self.unindexed.get(k, set())
+            if found is None:
+                found = equal
+            else:
+                found = found & equal
+        return found
+
+    def _within(self, i, ip):
+        if ip is None:
             return False
-    for line in netmap:
-        match = True
-        for key in line:
-            skip = False
-            for k in kv:
-                if k=='siteid' and key=='dom':
-                    for hey in line[key]:
-                        if kv[k] not in hey.split('.'):
-                            skip = True
-                            break
-                elif k=='ip' and key=='cidr':
-                    if not within(kv[k], line['cidr']):
-                        skip = True
-                        break
-                elif k==key and k=='dom':
-                    if kv[k] not in line['dom']:
-                      skip = True
-                      break
-                elif k==key and kv[k]!=line[key]:
-                    skip = True
-                    break
-            if skip:
-                match = False
-                break
-        if match:
+        rng = self.ranges[i]
+        if rng is None:
+            return within(ip, self.lines[i]['cidr'])
+        return rng[0] <= ip2long(ip) <= rng[1]
+
+    def match(self, i, kv):
+        """
+            Does line i satisfy every one of the kv requests
+        """
+        line = self.lines[i]
+        for k in kv:
+            if k == 'siteid' and 'dom' in line:
+                for hey in line['dom']:
+                    if kv[k] not in hey.split('.'):
+                        return False
+            elif k == 'ip' and 'cidr' in line:
+                if not self._within(i, kv[k]):
+                    return False
+            if k == 'dom':
+                if 'dom' in line and kv[k] not in line['dom']:
+                    return False
+            elif k in line and kv[k] != line[k]:
+                return False
+        return True
+
+    def find(self, **kv):
+        """
+            Indexes (in map order) of the lines matching kv
+        """
+        candidates = None
+        for k in kv:
+            found = self._narrow(k, kv[k])
+            if found is None:
+                continue
+            if candidates is None:
+                candidates = found
+            else:
+                candidates = candidates & found
+        if candidates is None:
+            candidates = self.all
+        return [i for i in sorted(candidates) if self.match(i, kv)]
+
+    def _positions(self, longs):
+        """
+            The segment (index into self.bounds) each long falls in,
+            -1 for those below every range
+        """
+        numpy = _numpy()
+        if numpy is not None and self.bounds:
+            bounds = numpy.array(self.bounds, dtype=numpy.int64)
+            found = numpy.searchsorted(bounds,
+                numpy.array(longs, dtype=numpy.int64), side='right') - 1
+            return found.tolist()
+        # sort the ips and walk them alongside the bounds
+        positions = [-1] * len(longs)
+        pos = -1
+        for n in sorted(range(len(longs)), key=longs.__getitem__):
+            while pos + 1 < len(self.bounds) and self.bounds[pos + 1] <= longs[n]:
+                pos += 1
+            positions[n] = pos
+        return positions
+
+    def classify(self, ips, **kv):
+        """
+            For each of ips, the first line of the map (in map order)
+            whose cidr contains it and which matches every kv filter,
+            None if there is none. The same answer remap() gives for
+            ip=<ip> with the same filters, but the ips are placed in
+            the cidr ranges in one sorted sweep and each range is only
+            resolved once, however many ips land in it
+        """
+        allowed = set(self.find(**kv))
+        no_cidr = self._missing('cidr')
+        longs = []
+        missing = set()
+        for n, ip in enumerate(ips):
+            if ip is None:
+                missing.add(n)
+                longs.append(0)
+            else:
+                longs.append(ip2long(ip))
+        resolved = {}
+        answers = []
+        for n, pos in enumerate(self._positions(longs)):
+            if n in missing:
+                pos = -1
+            if pos not in resolved:
+                candidates = no_cidr
+                if pos >= 0:
+                    candidates = candidates | self.segments[pos]
+                candidates = sorted(candidates & allowed)
+                if candidates:
+                    resolved[pos] = self.lines[candidates[0]]
+                else:
+                    resolved[pos] = None
+            answers.append(resolved[pos])
+        return answers
+
+    def get_mask(self, i):
+        if i not in self.masks:
+            self.masks[i] = get_netmask(self.lines[i]['cidr'])
+        return self.masks[i]
+
+    def remap(self, request, **kv):
+        """
+            Answer a remap() request, see remap() below
+        """
+        netblocks = []
+        doms = []
+        if request=='gw' or 'gw' in request:
+            if 'vlan' not in kv.keys() and 'ip' not in kv.keys():
+                print 'Either vlan or ip MUST be specified when requesting gw'
+                return False
+        for i in self.find(**kv):
+            line = self.lines[i]
             if type(request) is types.ListType:
                 answer = []
                 for r in request:
@@ -104,7 +391,7 @@ def remap(cfg, request, **kv):
                         if len(sets.Set(doms)) == 1:
                             answer.append(doms[0])
                     elif r == 'mask':
-                        answer.append(get_netmask(line['cidr']))
+                        answer.append(self.get_mask(i))
                     elif r == 'ip':   # legacy ip prefix
                         answer.append(re.sub('(\.0)+$', '', line['cidr'].split('/')[0]) + '.')
                     elif r in line:
@@ -116,49 +403,90 @@ def remap(cfg, request, **kv):
                 if request == 'siteid':
                     return line['dom'].split('.')[-3]
                 elif request == 'mask':
-                    return get_netmask(line['cidr'])
+                    return self.get_mask(i)
                 elif request == 'ip':   # legacy ip prefix
                     return re.sub('(\.0)+$', '', line['cidr'].split('/')[0]) + '.'
                 elif request == 'cidr':
                     netblocks.append(line['cidr'])
                 elif request in line:
                     return line[request]
-    if netblocks:
-        return netblocks
-    return False
+        if netblocks:
+            return netblocks
+        return False
 
-def generate_ipaddress_list(first, count=None, last=None):
+def get_network_map(cfg):
+    """
+        Returns the compiled NetworkMap for cfg.network_map, building it
+        the first time it is asked for (and again if cfg.network_map
+        is replaced)
+    """
+    cached = getattr(cfg, '_network_map_index', None)
+    if cached is None or cached.netmap is not cfg.network_map:
+        cached = NetworkMap(cfg.network_map)
+        cfg._network_map_index = cached
+    return cached
+
+def remap(cfg, request, **kv):
+    """
+       Look up request (a network map key, a list of them, or one of the
+       computed 'siteid', 'mask', 'ip' or 'cidr') for the first line of
+       cfg.network_map matching every kv filter:
+           siteid: a component of each of the line's domains
+           ip: inside the line's cidr
+           dom: one of the line's domains
+           anything else: equal to the line's value, if it has one
+       'cidr' returns the cidrs of all matching lines. Returns False if
+       nothing matches
+    """
+    return get_network_map(cfg).remap(request, **kv)
+
+def classify_ips(cfg, ips, **kv):
+    """
+       Bulk version of remap() for ip requests: returns, for each of
+       ips, the cfg.network_map line (cidr, vlan, nic, dom...) the ip
+       belongs to, given the same kv filters remap() takes (siteid, dom,
+       vlan...), or None where no line matches
+    """
+    return get_network_map(cfg).classify(ips, **kv)
+
+def iter_ipaddress_range(first, count=None, last=None):
     """
         Given a starting IP 'first'
-            generate a list up to 'count'
+            yield 'count' addresses
             OR
-            generate a list up to 'last'
+            yield addresses up to and including 'last'
+        one at a time, without building the whole list
     """
-    iplist = []
-    list_a = map(int,first.split("."))
-    cur_ip = list_a[:]
+    start = ip2long(first)
     if count:
-        for i in range(int(count)):
-            iplist.append('.'.join(map(str,cur_ip)))
-            cur_ip[3] += 1
-            for x in range(3,0,-1):
-                if cur_ip[x] > 255:
-                    cur_ip[x] = 0
-                    cur_ip[x-1] += 1
+        end = start + int(count) - 1
     elif last:
-        list_z = map(int,last.split("."))
+        # walk the octets the way the old octet counter did: each octet
+        # of 'first' that is below the same octet of 'last' is raised to
+        # it, clearing the octets after it. for first <= last this ends
+        # on last itself
+        cur = map(int, first.split('.'))
+        stop = map(int, last.split('.'))
         for i in range(4):
-            while cur_ip[i] < list_z[i]:
-                iplist.append('.'.join(map(str,cur_ip)))
-                cur_ip[3] += 1
-                for x in range(3,0,-1):
-                    if cur_ip[x] > 255:
-                        cur_ip[x] = 0
-                        cur_ip[x-1] += 1
-        iplist.append('.'.join(map(str,cur_ip)))
+            if cur[i] < stop[i]:
+                cur = cur[:i] + [stop[i]] + [0] * (3 - i)
+        end = ip2long('.'.join(map(str, cur)))
     else:
         print 'You must specify --count or --last in order to generated ip addresses'
-    return iplist
+        return
+    ip = start
+    while ip <= end:
+        yield long2ip(ip)
+        ip += 1
+
+def generate_ipaddress_list(first, count=None, last=None):
+    """
+        Given a starting IP 'first'
+            generate a list up to 'count'
+            OR
+            generate a list up to 'last'
+    """
+    return list(iter_ipaddress_range(first, count=count, last=last))
 
 def ip_to_mac(ip,pre='14:6E'):
     """
@@ -188,11 +516,4 @@ def next_ip(ipaddress):
         Simple method that tries to the next IPv4 address given
         an IPv4 address in dotted decimal (ex. 192.168.1.2)
     """
-    octet = map(int,ipaddress.split('.'))
-    octet[3] += 1
-    for x in range(3,0,-1):
-        if octet[x] > 255:
-            octet[x] = 0
-            octet[x-1] += 1
-    return '.'.join(map(str,octet))
-
+    return long2ip(ip2long(ipaddress) + 1)
@@ -0,0 +1,127 @@
+# Copyright 2011 Gilt Groupe, INC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+the puppet node classification cache
+
+"ship classify" keeps the yaml it renders for a node in the
+node_classification table, so the next run for that node is a single
+keyed read. every flush that touches something classify() reads
+drops the cached nodes it could have changed, in the same
+transaction:
+    servers, network:  the server's node
+    kv:                the nodes under the KV's scope (every node for
+                       a global KV)
+    groups:            the nodes in the group's realm.site_id
+    tags:              every node
+"""
+
+import hashlib
+
+from mothership.dns_journal import _versions
+from mothership.mothership_models import *
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.interfaces import SessionExtension
+
+# bump when classify() output changes, to drop every cached node
+version = 1
+
+def config_digest(cfg):
+    """
+        Digest of the settings classify() output depends on, so nodes
+        cached under another configuration aren't served
+    """
+    return hashlib.md5(repr((version, cfg.network_map, cfg.sudo_nopass))).hexdigest()
+
+def lookup(cfg, hostname, realm, site_id):
+    """
+        The cached yaml of a node, or None
+    """
+    row = cfg.dbsess.query(NodeClassification.cfg_digest, NodeClassification.yaml).\
+        filter(NodeClassification.hostname==hostname).\
+        filter(NodeClassification.realm==realm).\
+        filter(NodeClassification.site_id==site_id).\
+        first()
+    if row and row[0] == config_digest(cfg):
+        return row[1]
+    return None
+
+def store(cfg, hostname, realm, site_id, text):
+    """
+        Cache the yaml of a node. Losing a race to cache the same node
+        is fine, the other process stored the same thing
+    """
+    cfg.dbsess.merge(NodeClassification(hostname, realm, site_id,
+        config_digest(cfg), text))
+    try:
+        cfg.dbsess.commit()
+    except IntegrityError:
+        cfg.dbsess.rollback()
+
+def invalidate(session, scopes):
+    """
+        Drop the cached nodes under each (hostname, realm, site_id)
+        scope, None matching anything
+    """
+    scopes = set(scopes)
+    if (None, None, None) in scopes:
+        scopes = set([(None, None, None)])
+    for scope in scopes:
+        query = session.query(NodeClassification)
+        for column, value in zip([NodeClassification.hostname,
+            NodeClassification.realm, NodeClassification.site_id], scope):
+            if value is not None:
+                query = query.filter(column==value)
+        query.delete(synchronize_session=False)
+
+network_keys = ['server_id', 'ip', 'interface', 'netmask', 'static_route', 'bond_options']
+
+def changed_scopes(session, obj, deleted=False):
+    """
+        The scopes of the cached nodes a new, changed or deleted
+        object could change the classification of
+    """
+    scopes = set()
+    if isinstance(obj, Server):
+        for row in _versions(obj, ['hostname', 'realm', 'site_id'], deleted):
+            scopes.add((row['hostname'], row['realm'], row['site_id']))
+    elif isinstance(obj, Network):
+        for row in _versions(obj, network_keys, deleted):
+            if row['server_id']:
+                server = session.query(Server).get(row['server_id'])
+                if server:
+                    scopes.add((server.hostname, server.realm, server.site_id))
+    elif isinstance(obj, KV):
+        for row in _versions(obj, ['hostname', 'realm', 'site_id'], deleted):
+            scopes.add((row['hostname'], row['realm'], row['site_id']))
+    elif isinstance(obj, Groups):
+        for row in _versions(obj, ['realm', 'site_id'], deleted):
+            scopes.add((None, row['realm'], row['site_id']))
+    elif isinstance(obj, Tag):
+        scopes.add((None, None, None))
+    return scopes
+
+class CacheExtension(SessionExtension):
+    """
+        Drops the cached nodes each flush could change
+    """
+    def before_flush(self, session, flush_context, instances):
+        scopes = set()
+        for obj in list(session.new) + list(session.dirty):
+            if session.is_modified(obj) or obj in session.new:
+                scopes |= changed_scopes(session, obj)
+        for obj in list(session.deleted):
+            scopes |= changed_scopes(session, obj, deleted=True)
+        if scopes:
+            invalidate(session, scopes)
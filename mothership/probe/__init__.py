@@ -0,0 +1,172 @@
+# Copyright 2011 Gilt Groupe, INC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+liveness probes for picking free ip addresses
+
+an ip the database thinks is free may still be answering (a host
+nobody registered), so candidates are probed before being handed
+out. probes run in parallel batches, but the answer is always the
+first free candidate in the order they were given
+"""
+
+import os
+import re
+import signal
+import threading
+import subprocess
+
+
+class ProbeError(Exception):
+    pass
+
+
+class IcmpProbe(object):
+    """
+        Pings the address. Alive if any reply comes back, dead only if
+        ping reports 0 packets received. Anything else (no ping
+        summary, ping killed at the timeout) is "unknown"
+    """
+    received = re.compile(r"(\d+)( packets)? received")
+
+    def __init__(self, timeout=2, count=2, command='ping'):
+        self.timeout = timeout
+        self.count = count
+        self.command = command
+
+    def __call__(self, ip):
+        # iputils ping flags: -q summary only, -n no reverse lookups,
+        # -c replies to ask for, -W seconds to wait for each reply.
+        # Other pings read -W differently (or not at all), so the
+        # timer below is what bounds the wait: kill ping if it overstays
+        proc = subprocess.Popen([self.command, '-q', '-n', '-c%d' % self.count,
+            '-W%d' % self.timeout, ip], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        timer = threading.Timer(self.timeout * self.count + 1, self._kill, [proc])
+        timer.start()
+        try:
+            output = proc.communicate()[0]
+        finally:
+            timer.cancel()
+        match = self.received.search(output)
+        if not match:
+            return None
+        return int(match.group(1)) > 0
+
+    def _kill(self, proc):
+        try:
+            os.kill(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+class ArpProbe(object):
+    """
+        Looks the address up in the kernel arp cache (/proc/net/arp).
+        Alive if there is a complete entry for it. Only meaningful
+        for vlans this host sits on, and only as fresh as the cache
+    """
+    def __init__(self, path='/proc/net/arp'):
+        self.path = path
+
+    def __call__(self, ip):
+        try:
+            table = open(self.path).readlines()[1:]
+        except IOError, e:
+            raise ProbeError("cannot read arp cache %s: %s" % (self.path, e))
+        for line in table:
+            fields = line.split()
+            # ip, hw type, flags, mac, mask, device. 0x2 is ATF_COM
+            if len(fields) >= 4 and fields[0] == ip:
+                return bool(int(fields[2], 16) & 0x2)
+        return False
+
+
+class StubProbe(object):
+    """
+        Answers from a fixed set of live addresses, for testing and
+        for dry runs where nothing should be touched
+    """
+    def __init__(self, alive=None):
+        self.alive = set(alive or [])
+        self.probed = []
+
+    def __call__(self, ip):
+        self.probed.append(ip)
+        return ip in self.alive
+
+
+backends = {
+    'icmp': IcmpProbe,
+    'arp': ArpProbe,
+    'stub': StubProbe,
+}
+
+def get_probe(cfg):
+    """
+        The probe backend configured in the probe section of
+        mothership.yaml
+    """
+    if cfg.probe_backend not in backends:
+        raise ProbeError("unknown probe backend \"%s\", pick one of: %s"
+            % (cfg.probe_backend, ', '.join(sorted(backends))))
+    if cfg.probe_backend == 'icmp':
+        return IcmpProbe(timeout=cfg.probe_timeout, count=cfg.probe_count)
+    return backends[cfg.probe_backend]()
+
+def probe_batch(probe, ips):
+    """
+        Probe every one of ips at the same time, one thread each.
+        Returns the results in the same order as ips: True (alive),
+        False (dead) or None (couldn't tell)
+    """
+    results = [None] * len(ips)
+    def run(n, ip):
+        try:
+            results[n] = probe(ip)
+        except Exception:
+            results[n] = None
+    threads = []
+    for n, ip in enumerate(ips):
+        t = threading.Thread(target=run, args=(n, ip))
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    return results
+
+def first_free(cfg, candidates, probe=None):
+    """
+        Returns the first of candidates (any iterable of ips, in the
+        order they should be handed out) that a probe says is dead,
+        or None. Candidates are probed cfg.probe_workers at a time,
+        so a run of live addresses costs one probe timeout per batch
+        instead of one per address. Addresses the probe can't vouch
+        for are skipped, like live ones
+    """
+    if probe is None:
+        probe = get_probe(cfg)
+    workers = max(1, int(cfg.probe_workers))
+    candidates = iter(candidates)
+    while True:
+        batch = []
+        for ip in candidates:
+            batch.append(ip)
+            if len(batch) >= workers:
+                break
+        if not batch:
+            return None
+        for ip, alive in zip(batch, probe_batch(probe, batch)):
+            if alive is False:
+                return ip
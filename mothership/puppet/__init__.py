@@ -17,15 +17,144 @@ mothership.puppet
 module controlling various puppet interactions
 """
 
+import yaml
+
+from sqlalchemy import or_, and_, select, union_all, literal_column, null
+
 import mothership
 import mothership.kv
 import mothership.users
+import mothership.node_cache
 import mothership.network_mapper
 from mothership.mothership_models import *
 
 def classify(cfg, name):
     """
     Puppet external node classifier.  Returns the hash to dump as yaml.
+    Runs three queries: the server and its tag, its network rows, and
+    its KVs together with its sudo groups
+    """
+    networks = []
+    hostname, realm, site_id = mothership.get_unqdn(cfg, name)
+    unqdn = "%s.%s.%s" % (hostname, realm, site_id)
+
+    # Server and tag
+    server, mtag = cfg.dbsess.query(Server, Tag).\
+        outerjoin((Tag, Tag.name==Server.tag)).\
+        filter(Server.hostname==hostname).\
+        filter(Server.realm==realm).\
+        filter(Server.site_id==site_id).\
+        first() or (None, None)
+    if not server:
+        raise mothership.users.UsersError("Host does not exist: %s" % unqdn)
+
+    if server.id:
+        networks = cfg.dbsess.query(Network).\
+                filter(Network.server_id==server.id).all()
+
+    kvs, sudo = _kvs_and_sudo(cfg, hostname, realm, site_id, server.tag)
+    sudoers = mothership.users.sudoers_lines(cfg, _sudo_groups(kvs, server.tag, sudo))
+
+    return _node(cfg, hostname, realm, site_id, server, mtag, networks, kvs, sudoers)
+
+def _kvs_and_sudo(cfg, hostname, realm, site_id, tag):
+    """
+    The KVs that apply to hostname.realm.site_id, in kv.collect()
+    order, and {groupname: Groups} of the <tag>_sudo groups of its
+    server tag and KV tags, read with one query
+    """
+    kv = KV.__table__
+    groups = Groups.__table__
+    scopes = []
+    for h in [None, hostname]:
+        for r in [None, realm]:
+            for s in [None, site_id]:
+                scopes.append((h, r, s))
+    in_scope = or_(*[and_(kv.c.hostname==h, kv.c.realm==r, kv.c.site_id==s)
+        for (h, r, s) in scopes])
+    names = select([kv.c.value + '_sudo'], and_(kv.c.key=='tag', in_scope))
+    if tag:
+        names = or_(groups.c.groupname.in_(names), groups.c.groupname==tag + '_sudo')
+    else:
+        names = groups.c.groupname.in_(names)
+    query = union_all(
+        select([literal_column("'kv'").label('kind'), kv.c.id, kv.c.key.label('name'),
+            kv.c.value, kv.c.hostname, kv.c.realm, kv.c.site_id], in_scope),
+        select([literal_column("'sudo'"), groups.c.id, groups.c.groupname,
+            groups.c.sudo_cmds, null(), groups.c.realm, groups.c.site_id],
+            and_(groups.c.realm==realm, groups.c.site_id==site_id, names)))
+    kvs = []
+    sudo = {}
+    for (kind, id, name, value, h, r, s) in sorted(cfg.dbsess.execute(query), key=lambda row: row[1]):
+        if kind == 'kv':
+            row = KV(name, value, h, r, s)
+            row.id = id
+            kvs.append(row)
+        elif name not in sudo:
+            sudo[name] = Groups(None, value, name, s, r, None)
+    # least specific scope first, as kv.collect() returns them
+    kvs.sort(key=lambda row: scopes.index((row.hostname, row.realm, row.site_id)))
+    return kvs, sudo
+
+def _sudo_groups(kvs, tag, sudo):
+    """
+    The sudo groups of a server, in gen_sudoers_groups() order: those
+    of its KV tags, then its server tag's
+    """
+    groups = []
+    for t in [kv.value for kv in kvs if kv.key == 'tag'] + [tag]:
+        if t and t + '_sudo' in sudo:
+            groups.append(sudo[t + '_sudo'])
+    return groups
+
+def classify_many(cfg, realm, site_id):
+    """
+    classify() every server in realm.site_id, reading them, their tags,
+    network rows, KVs and sudo groups with one query each. Yields
+    (unqdn, node) for each server, ordered by hostname
+    """
+    rows = cfg.dbsess.query(Server, Tag).\
+        outerjoin((Tag, Tag.name==Server.tag)).\
+        filter(Server.realm==realm).\
+        filter(Server.site_id==site_id).\
+        order_by(Server.hostname, Server.id).all()
+    servers = []
+    seen = {}
+    for (server, mtag) in rows:
+        # like classify(), the first server of a name wins
+        if server.hostname not in seen:
+            seen[server.hostname] = True
+            servers.append((server, mtag))
+
+    networks = {}
+    for network in cfg.dbsess.query(Network).\
+            filter(Network.server_id==Server.id).\
+            filter(Server.realm==realm).\
+            filter(Server.site_id==site_id).\
+            order_by(Network.id):
+        networks.setdefault(network.server_id, []).append(network)
+
+    cfg.kvcache.load_site(cfg, realm, site_id, [s.hostname for (s, t) in servers])
+
+    # the <tag>_sudo groups of the site
+    sudo = {}
+    for g in cfg.dbsess.query(Groups).\
+            filter(Groups.realm==realm).\
+            filter(Groups.site_id==site_id).\
+            filter(Groups.groupname.like('%_sudo')).\
+            order_by(Groups.id):
+        sudo.setdefault(g.groupname, g)
+
+    for (server, mtag) in servers:
+        unqdn = "%s.%s.%s" % (server.hostname, realm, site_id)
+        kvs = mothership.kv.collect(cfg, unqdn)
+        sudoers = mothership.users.sudoers_lines(cfg, _sudo_groups(kvs, server.tag, sudo))
+        yield unqdn, _node(cfg, server.hostname, realm, site_id, server,
+            mtag, networks.get(server.id, []), kvs, sudoers)
+
+def _node(cfg, hostname, realm, site_id, server, mtag, networks, kvs, sudoers):
+    """
+    Puts together the node hash of a server from its rows
     """
     classes = []
     mtags = []
@@ -33,12 +162,6 @@ def classify(cfg, name):
     parameters = {}
     groups = []
     security_level = 0
-    server = None
-    server_id = None
-    mtag = None
-    networks = []
-    sudoers = []
-    hostname, realm, site_id = mothership.get_unqdn(cfg, name)
 
     # Unique or unqualified domain name
     unqdn = "%s.%s.%s" % (hostname, realm, site_id)
@@ -50,19 +173,8 @@ def classify(cfg, name):
     for g in mothership.add_ldap_groups(hostname, realm, site_id):
         groups.append(g)
 
-    # Server
-    server = cfg.dbsess.query(Server).\
-        filter(Server.hostname==hostname).\
-        filter(Server.realm==realm).\
-        filter(Server.site_id==site_id).\
-        first()
-    if server:
-        mtag = cfg.dbsess.query(Tag).filter(Tag.name==server.tag).first()
-
     if server and server.id:
         parameters['server_id'] = server.id
-        networks = cfg.dbsess.query(Network).\
-                filter(Network.server_id==server.id).all()
         for network in networks:
             if network.interface=='eth0':
                 if network.static_route:
@@ -107,7 +219,6 @@ def classify(cfg, name):
         parameters['security_level'] = security_level
 
     # Key/values
-    kvs = mothership.kv.collect(cfg, unqdn)
     for kv in kvs:
         key = kv.key
         value = kv.value
@@ -127,9 +238,6 @@ def classify(cfg, name):
     if not environment:
         environment = site_id
 
-    # sudoers
-    sudoers = mothership.users.gen_sudoers_groups(cfg, unqdn)
-
     parameters['mtags'] = mtags
     parameters['groups'] = groups
     if sudoers:
@@ -141,3 +249,18 @@ def classify(cfg, name):
     node['parameters'] = parameters
 
     return node
+
+def classify_yaml(cfg, name, fresh=False):
+    """
+    classify() as yaml, from the node classification cache (see
+    mothership.node_cache) if the node is in it. Otherwise, or with
+    fresh, the node is classified and cached
+    """
+    hostname, realm, site_id = mothership.get_unqdn(cfg, name)
+    if not fresh:
+        text = mothership.node_cache.lookup(cfg, hostname, realm, site_id)
+        if text is not None:
+            return text
+    text = yaml.dump(classify(cfg, name), default_flow_style=False)
+    mothership.node_cache.store(cfg, hostname, realm, site_id, text)
+    return text
@@ -20,18 +20,19 @@ be paired with a system-level user management system
 such as LDAP or /etc/passwd
 """
 
-# system imports
-import ldap
-
 # mothership imports
+# (mothership.ldap, and python-ldap with it, is loaded the first
+# time one of the ldap_active branches below uses it)
 import mothership
 import mothership.ssh
-import mothership.ldap
 
 # All of the models and sqlalchemy are brought in
 # to simplify referencing
 from mothership.mothership_models import *
 
+from sqlalchemy import and_, exists, func, literal_column, select, union_all
+from sqlalchemy.exc import IntegrityError
+
 class UsersError(Exception):
     pass
 
@@ -308,7 +309,7 @@ def uclone(cfg, username, newfqn):
     d = cfg.domain.split('.')
     dn += ',dc='.join(d)
     ldcon = mothership.ldap.ld_connect(cfg, ldap_master, newu.realm, newu.site_id)
-    ldap_user_entry = ldcon.search_s(dn, ldap.SCOPE_BASE)
+    ldap_user_entry = ldcon.search_s(dn, mothership.ldap.ldap.SCOPE_BASE)
     if cfg.ldap_active and ldap_master and not ldap_user_entry:
         ans = raw_input('Do you want to add this user to LDAP as well? (y/n): ')
         if ans == 'y' or ans == 'Y':
@@ -334,10 +335,76 @@ def uclone(cfg, username, newfqn):
     return newu
 
 
+def lock_ids(cfg, kind, realm, site_id):
+    """
+    [description]
+    locks the id_allocation row of kind ('uid' or 'gid') in realm.site_id (SELECT ... FOR UPDATE) until the session commits, so concurrent allocations there take turns and each sees the id the previous one committed. the row is created the first time
+
+    [parameter info]
+    required:
+        cfg: the config object. useful everywhere
+        kind: 'uid' or 'gid'
+        realm: the realm we're allocating in
+        site_id: the site_id we're allocating in
+
+    [return value]
+    no explicit return
+    """
+    for attempt in range(2):
+        if cfg.dbsess.query(IdAllocation).\
+        filter(IdAllocation.kind==kind).\
+        filter(IdAllocation.realm==realm).\
+        filter(IdAllocation.site_id==site_id).\
+        with_lockmode('update').first():
+            return
+        # the inserted row stays locked until the commit too
+        cfg.dbsess.add(IdAllocation(kind, realm, site_id))
+        try:
+            cfg.dbsess.flush()
+            return
+        except IntegrityError:
+            # somebody else created it first, wait for their lock
+            cfg.dbsess.rollback()
+    raise UsersError("Unable to lock %s allocation in %s.%s" % (kind, realm, site_id))
+
+
+def next_free_id(cfg, table, column, realm, site_id, start, end):
+    """
+    [description]
+    finds the lowest value of column in [start, end) that no row of table in realm.site_id has, with a single query: the candidates are start and every value in use plus one, and the answer is the lowest candidate not in use
+
+    [parameter info]
+    required:
+        cfg: the config object. useful everywhere
+        table: the table holding the ids (Users.__table__ or Groups.__table__)
+        column: the name of the id column ('uid' or 'gid')
+        realm: the realm we're checking ids for
+        site_id: the site_id we're checking ids for
+        start: the first id of the range
+        end: the id after the last one of the range
+
+    [return value]
+    returns an integer, or None if every id in the range is taken
+    """
+    if start >= end:
+        return None
+    ids = table.c[column]
+    taken = table.alias('taken')
+    candidates = union_all(
+        select([literal_column(str(int(start))).label('id')]),
+        select([(ids + 1).label('id')], and_(table.c.realm==realm,
+            table.c.site_id==site_id, ids >= start, ids < end - 1))).\
+        alias('candidates')
+    query = select([func.min(candidates.c.id)],
+        ~exists([taken.c[column]], and_(taken.c.realm==realm,
+            taken.c.site_id==site_id, taken.c[column]==candidates.c.id)))
+    return cfg.dbsess.execute(query).scalar()
+
+
 def next_available_uid(cfg, realm, site_id):
     """
     [description]
-    searches the db for existing UIDS and picks the next available UID within the parameters configured in mothership.yaml
+    picks the lowest UID within the parameters configured in mothership.yaml that no user in realm.site_id has. uid allocation in realm.site_id stays locked until the caller commits the user it gives the UID to, see lock_ids()
 
     [parameter info]
     required:
@@ -349,35 +416,17 @@ def next_available_uid(cfg, realm, site_id):
     returns an integer representing the next available UID
     """
 
-    i = cfg.uid_start
-    uidlist = []
-    u = cfg.dbsess.query(Users).\
-    filter(Users.realm==realm).\
-    filter(Users.site_id==site_id).all()
-    for userentry in u:
-        uidlist.append(userentry.uid)
-    uidlist.sort(key=int)
-    if not uidlist:
-        # if we don't have any users in the users table
-        # return the default first uid as configured in the yaml
-        return cfg.uid_start
-    else:
-        for uu in uidlist:
-            if uu < cfg.uid_start:
-                pass
-            elif not i == uu and i < cfg.uid_end:
-                return i
-            elif i < cfg.uid_end:
-                i += 1
-            else:
-                raise UsersError("No available UIDs!")
-        return i
+    lock_ids(cfg, 'uid', realm, site_id)
+    uid = next_free_id(cfg, Users.__table__, 'uid', realm, site_id, cfg.uid_start, cfg.uid_end)
+    if uid is None:
+        raise UsersError("No available UIDs!")
+    return uid
 
 
 def next_available_gid(cfg, realm, site_id):
     """
     [description]
-    searches the db for existing GIDS and picks the next available GID within the parameters configured in mothership.yaml
+    picks the lowest GID within the parameters configured in mothership.yaml that no group in realm.site_id has. gid allocation in realm.site_id stays locked until the caller commits the group it gives the GID to, see lock_ids()
 
     [parameter info]
     required:
@@ -389,29 +438,11 @@ def next_available_gid(cfg, realm, site_id):
     returns an integer representing the next available GID
     """
 
-    i = cfg.gid_start
-    gidlist = []
-    g = cfg.dbsess.query(Groups).\
-    filter(Groups.realm==realm).\
-    filter(Groups.site_id==site_id).all()
-    for groupentry in g:
-        gidlist.append(groupentry.gid)
-    gidlist.sort(key=int)
-    if not gidlist:
-        # if we don't have any groups in the groups table
-        # return the default first gid as configured in the yaml
-        return cfg.gid_start
-    else:
-        for gg in gidlist:
-            if gg < cfg.gid_start:
-                pass
-            elif not i == gg and i < cfg.gid_end:
-                return i
-            elif i < cfg.gid_end:
-                i += 1
-            else:
-                raise UsersError("No available GIDs!")
-        return i
+    lock_ids(cfg, 'gid', realm, site_id)
+    gid = next_free_id(cfg, Groups.__table__, 'gid', realm, site_id, cfg.gid_start, cfg.gid_end)
+    if gid is None:
+        raise UsersError("No available GIDs!")
+    return gid
 
 
 def uwrite_pubkey(cfg, username, keyfile=None):
@@ -1219,7 +1250,7 @@ def gclone(cfg, groupname, newfqn):
     dn += ',dc='.join(d)
     ldcon = mothership.ldap.ld_connect(cfg, ldap_master, newg.realm, newg.site_id)
     try:
-        ldap_group_entry = ldcon.search_s(dn, ldap.SCOPE_BASE)
+        ldap_group_entry = ldcon.search_s(dn, mothership.ldap.ldap.SCOPE_BASE)
     except:
         ldap_group_entry = None
     if cfg.ldap_active and ldap_master and not ldap_group_entry:
@@ -1469,7 +1500,21 @@ def gen_sudoers_groups(cfg, unqdn):
     else:
         pass
 
-    # stitch it all together
+    return sudoers_lines(cfg, groups)
+
+def sudoers_lines(cfg, groups):
+    """
+    [description]
+    stitches sudo groups together into the group lines for sudoers
+
+    [parameter info]
+    required:
+        cfg: the config object. useful everywhere
+        groups: the Groups objects, in the order of their lines
+
+    [return value]
+    returns a list of sudoers lines, or None if there are none
+    """
     sudoers = []
     for g in groups:
         if cfg.sudo_nopass and g.sudo_cmds:
@@ -24,7 +24,7 @@ import mothership
 
 # Useful handy functions brought in from mothership
 from mothership.kv import collect as kv_collect
-from mothership.kv import select as kv_select
+from mothership.kv import get_many as kv_get_many
 
 # All of the models and sqlalchemy are brought in
 # to simplify referencing
@@ -60,8 +60,7 @@ def add(cfg, unqdn, zs_unqdn, zabbix_template):
     if zs_unqdn==None:
       zs_unqdn, zs_user, zs_pass = get_default_server(cfg, realm, site_id)
     else:
-      zs_user = str(kv_select(cfg, zs_unqdn, key="zabbix_admin_user")).split('=')[1]
-      zs_pass = str(kv_select(cfg, zs_unqdn, key="zabbix_admin_pass")).split('=')[1]
+      zs_user, zs_pass = get_credentials(cfg, zs_unqdn)
     zs_host,zs_realm,zs_site_id = mothership.split_fqdn(zs_unqdn)
     zs_fqdn = '.'.join([zs_unqdn,cfg.domain])
 
@@ -82,7 +81,7 @@ def add(cfg, unqdn, zs_unqdn, zabbix_template):
 
     # Construct the tag template name.
     # All templates descend from the default
-    discard,zab_def_tmpl = str(kv_select(cfg, '', key="zabbix_default_template")).split('=')
+    zab_def_tmpl = kv_get_many(cfg, '', ['zabbix_default_template'])['zabbix_default_template']
     # uncomment to debug
     #print 'Default template is: ' + zab_def_tmpl
     zab_tag_tmpl = zab_def_tmpl + '_' + s.tag
@@ -125,7 +124,7 @@ def add(cfg, unqdn, zs_unqdn, zabbix_template):
            print "Templates goup id is empty, something went wrong"
 
         # Get the template ID for the default template
-        discard,zab_def_tmpl = str(kv_select(cfg, '', key="zabbix_default_template")).split('=')
+        zab_def_tmpl = kv_get_many(cfg, '', ['zabbix_default_template'])['zabbix_default_template']
         t = zapi.template.get(host=zab_def_tmpl)
         if t:
           for k in t.keys():
@@ -163,7 +162,7 @@ def add(cfg, unqdn, zs_unqdn, zabbix_template):
            print "Templates goup id is empty, something went wrong"
 
         # Get the template ID for the default template
-        discard,zab_def_tmpl = str(kv_select(cfg, '', key="zabbix_default_template")).split('=')
+        zab_def_tmpl = kv_get_many(cfg, '', ['zabbix_default_template'])['zabbix_default_template']
         t = zapi.template.get(host=zab_def_tmpl)
         if t:
           for k in t.keys():
@@ -239,8 +238,7 @@ def remove(cfg, unqdn, zs_unqdn):
     if zs_unqdn==None:
       zs_unqdn, zs_user, zs_pass = get_default_server(cfg, realm, site_id)
     else:
-      zs_user = str(kv_select(cfg, zs_unqdn, key="zabbix_admin_user")).split('=')[1]
-      zs_pass = str(kv_select(cfg, zs_unqdn, key="zabbix_admin_pass")).split('=')[1]
+      zs_user, zs_pass = get_credentials(cfg, zs_unqdn)
     zs_host,zs_realm,zs_site_id = mothership.split_fqdn(zs_unqdn)
     zs_fqdn = '.'.join([zs_unqdn,cfg.domain])
 
@@ -311,8 +309,7 @@ def enable(cfg, unqdn, zs_unqdn):
     if zs_unqdn==None:
       zs_unqdn, zs_user, zs_pass = get_default_server(cfg, realm, site_id)
     else:
-      zs_user = str(kv_select(cfg, zs_unqdn, key="zabbix_admin_user")).split('=')[1]
-      zs_pass = str(kv_select(cfg, zs_unqdn, key="zabbix_admin_pass")).split('=')[1]
+      zs_user, zs_pass = get_credentials(cfg, zs_unqdn)
     zs_host,zs_realm,zs_site_id = mothership.split_fqdn(zs_unqdn)
     zs_fqdn = '.'.join([zs_unqdn,cfg.domain])
 
@@ -376,8 +373,7 @@ def disable(cfg, unqdn, zs_unqdn):
     if zs_unqdn==None:
       zs_unqdn, zs_user, zs_pass = get_default_server(cfg, realm, site_id)
     else:
-      zs_user = str(kv_select(cfg, zs_unqdn, key="zabbix_admin_user")).split('=')[1]
-      zs_pass = str(kv_select(cfg, zs_unqdn, key="zabbix_admin_pass")).split('=')[1]
+      zs_user, zs_pass = get_credentials(cfg, zs_unqdn)
     zs_host,zs_realm,zs_site_id = mothership.split_fqdn(zs_unqdn)
     zs_fqdn = '.'.join([zs_unqdn,cfg.domain])
 
@@ -440,8 +436,7 @@ def display(cfg, unqdn, zs_unqdn):
     if zs_unqdn==None:
       zs_unqdn, zs_user, zs_pass = get_default_server(cfg, realm, site_id)
     else:
-      zs_user = str(kv_select(cfg, zs_unqdn, key="zabbix_admin_user")).split('=')[1]
-      zs_pass = str(kv_select(cfg, zs_unqdn, key="zabbix_admin_pass")).split('=')[1]
+      zs_user, zs_pass = get_credentials(cfg, zs_unqdn)
     zs_host,zs_realm,zs_site_id = mothership.split_fqdn(zs_unqdn)
     zs_fqdn = '.'.join([zs_unqdn,cfg.domain])
 
@@ -475,7 +470,7 @@ def display(cfg, unqdn, zs_unqdn):
 
    
     # get default template info 
-    discard,zab_def_tmpl = str(kv_select(cfg, '', key="zabbix_default_template")).split('=')
+    zab_def_tmpl = kv_get_many(cfg, '', ['zabbix_default_template'])['zabbix_default_template']
     t = zapi.template.get(host=zab_def_tmpl)
     if t:
       for k in t.keys():
@@ -508,6 +503,24 @@ def display(cfg, unqdn, zs_unqdn):
         print "Host not found: " + unqdn
 
 
+def get_credentials(cfg, zs_unqdn):
+    """
+    [description]
+    retrieves the zabbix admin user and pass for a zabbix server, both from the KV in one lookup
+
+    [parameter info]
+    required:
+        cfg: the config object. useful everywhere
+        zs_unqdn: unqdn of the zabbix server
+
+    [return value]
+    returns zs_user, zs_pass as a list
+    """
+
+    creds = kv_get_many(cfg, zs_unqdn, ['zabbix_admin_user', 'zabbix_admin_pass'])
+    return [creds['zabbix_admin_user'], creds['zabbix_admin_pass']]
+
+
 def get_default_server(cfg, realm, site_id):
     """
     [description]
@@ -531,8 +544,7 @@ def get_default_server(cfg, realm, site_id):
     first()
     
     zs_unqdn = '.'.join([serv.hostname,realm,site_id])
-    discard,zs_user = str(kv_select(cfg, zs_unqdn, key="zabbix_admin_user")).split('=')
-    discard,zs_pass = str(kv_select(cfg, zs_unqdn, key="zabbix_admin_pass")).split('=')
+    zs_user, zs_pass = get_credentials(cfg, zs_unqdn)
 
     retval = [zs_unqdn, zs_user, zs_pass]
     return retval
@@ -45,6 +45,20 @@ ROUTERS = { 'MessagingRouter': 'messaging',
 class ZenossError(Exception):
     pass
 
+def get_auth(cfg):
+    """
+    The auth dict for ZenossAPI: the zenoss server named by the global
+    zenoss_server KV, and its zenoss_api_user, zenoss_api_pass and
+    zenoss_default_arch KVs (read together)
+    """
+    import mothership
+    import mothership.kv
+    zserver = mothership.kv.get_many(cfg, '', ['zenoss_server'])['zenoss_server']
+    zhost = '.'.join(mothership.get_unqdn(cfg, zserver))
+    creds = mothership.kv.get_many(cfg, zhost,
+        ['zenoss_api_user', 'zenoss_api_pass', 'zenoss_default_arch'])
+    return dict([(k.split('_')[-1], v) for (k, v) in creds.items()], host=zhost)
+
 class ZenossAPI:
     def __init__(self, auth, debug=False):
         """
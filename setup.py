@@ -10,7 +10,8 @@ install_requires = [
 
 extras_require = {
     'ldap' : 'python-ldap',
-    'postgres' : 'psycopg2'
+    'postgres' : 'psycopg2',
+    'numpy' : 'numpy'
     }
 
 setup(name='Mothership',
@@ -19,7 +20,10 @@ setup(name='Mothership',
       description='Mothership - asset managment',
       packages=find_packages(),
       scripts=['ship',
-               'ship_readonly'
+               'ship_readonly',
+               'shipd',
+               'ship_client',
+               'ship_enc'
                ],
       url='http://mothership.sf.net',
       version='0.0.28',